@@ -4,3 +4,10 @@ nbiotpy python library for uBlox SARA-N210 modem
 
 from .nbiot import *
 from .atcommands import *
+from .fragment import *
+from .link import *
+from .transport import *
+from .probe import *
+from .accounting import *
+from .scheduler import *
+from .netprofile import *
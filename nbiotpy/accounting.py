@@ -0,0 +1,311 @@
+# Copyright (C) 2018  Distributed Arctic Observatory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Accounting of uplink traffic, serial traffic and radio time with budget enforcement
+"""
+
+import time
+import threading
+from collections import Counter, deque
+from timeit import default_timer as timer
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+# metrics which can be limited by Budget
+PAYLOAD_BYTES = 'payload_bytes'
+DATAGRAMS = 'datagrams'
+RADIO_TIME = 'radio_time'
+
+REJECT = 'reject'
+THROTTLE = 'throttle'
+
+
+class Usage:
+    """Counters of a single socket, destination or time window
+
+    :ivar int payload_bytes: uplink payload bytes
+    :ivar int datagrams: uplink datagrams
+    :ivar int serial_tx: bytes written to the modem
+    :ivar int serial_rx: bytes read from the modem
+    :ivar int commands: AT commands issued
+    :ivar float radio_time: estimated seconds the radio was connected
+    """
+
+    def __init__(self):
+        self.payload_bytes = 0
+        self.datagrams = 0
+        self.serial_tx = 0
+        self.serial_rx = 0
+        self.commands = 0
+        self.radio_time = 0.0
+
+    def as_dict(self):
+        """Returns counters as dict
+
+        :rtype: dict
+        """
+        return dict(self.__dict__)
+
+
+class Budget:
+    """Limit of a single metric over fixed time windows
+
+    Windows are aligned to the wall clock (UTC), e.g. every full hour for HOUR. Low priority sends may use
+    only ``(1 - reserve) * limit``, the rest is kept for high priority ones.
+
+    :ivar str metric: PAYLOAD_BYTES, DATAGRAMS or RADIO_TIME
+    :ivar float limit: maximal usage in a single window
+    :ivar int period: window length in seconds, e.g. HOUR or DAY
+    :ivar float reserve: part of the limit reserved for high priority sends
+    """
+
+    def __init__(self, metric, limit, period=DAY, reserve=0.1):
+        """
+        :param str metric:
+        :param float limit:
+        :param int period:
+        :param float reserve:
+        """
+        self.metric = metric
+        self.limit = limit
+        self.period = period
+        self.reserve = reserve
+
+
+class Accountant:
+    """Collects usage reported by NbIoT and decides if uplinks fit into the budgets
+
+    Radio time is estimated from uplinks only: every datagram keeps the radio connected for radio_tail
+    seconds (the network inactivity timer), overlapping tails are counted once.
+
+    In REJECT mode low priority sends which do not fit are refused. In THROTTLE mode the low priority part
+    of every budget is spread evenly over its window, and low priority sends wait (up to max_wait seconds)
+    until they fit the pace. High priority sends are never refused, the ones exceeding a budget are only
+    counted in over_budget.
+
+    :ivar list(Budget) budgets: enforced budgets
+    :ivar float radio_tail: seconds the radio stays connected after an uplink
+    :ivar str mode: REJECT or THROTTLE
+    :ivar float max_wait: maximal number of seconds a throttled send waits
+    :ivar Usage total: usage since creation
+    :ivar dict sockets: socket number -> Usage
+    :ivar dict destinations: (ip_address, port) -> Usage
+    :ivar dict windows: period -> deque of (window start, Usage), the latest last
+    :ivar Counter commands: AT command -> number of times issued
+    :ivar int rejected: number of refused sends
+    :ivar int over_budget: number of high priority sends admitted over a budget limit
+    """
+
+    def __init__(self, budgets=None, radio_tail=20.0, mode=REJECT, max_wait=60.0, history=24):
+        """
+        :param list(Budget) budgets:
+        :param float radio_tail:
+        :param str mode:
+        :param float max_wait:
+        :param int history: number of windows kept for every period
+        """
+        self.budgets = list(budgets or [])
+        self.radio_tail = radio_tail
+        self.mode = mode
+        self.max_wait = max_wait
+        self.total = Usage()
+        self.sockets = {}
+        self.destinations = {}
+        self.commands = Counter()
+        self.rejected = 0
+        self.over_budget = 0
+
+        periods = set([HOUR, DAY] + [b.period for b in self.budgets])
+        self.windows = dict((period, deque(maxlen=history)) for period in periods)
+
+        self._connected_until = None
+        self._lock = threading.RLock()
+
+    def on_command(self, cmd, nbytes, socket=None, addr=None):
+        """Records AT command written to the modem
+
+        :param str cmd: command name, e.g. SOST
+        :param int nbytes: bytes written
+        :param int socket: modem socket number the command belongs to, None for modem management
+        :param (str, int) addr: destination the command belongs to, None if not known
+        """
+        with self._lock:
+            self.commands[cmd] += 1
+            for usage in self.__current() + self.__owners(socket, addr):
+                usage.commands += 1
+                usage.serial_tx += nbytes
+
+    def on_serial_rx(self, nbytes, socket=None, addr=None):
+        """Records bytes read from the modem
+
+        :param int nbytes:
+        :param int socket: modem socket number the response belongs to, None for modem management
+        :param (str, int) addr: destination the response belongs to, None if not known
+        """
+        with self._lock:
+            for usage in self.__current() + self.__owners(socket, addr):
+                usage.serial_rx += nbytes
+
+    def on_uplink(self, socket, addr, nbytes):
+        """Records datagram sent by the modem
+
+        :param int socket: modem socket number
+        :param (str, int) addr: destination (ip_address, port)
+        :param int nbytes: payload bytes
+        """
+        with self._lock:
+            radio_time = self.__radio_time(timer(), commit=True)
+            usages = self.__current() + self.__owners(socket, addr)
+
+            for usage in usages:
+                usage.payload_bytes += nbytes
+                usage.datagrams += 1
+                usage.radio_time += radio_time
+
+    def admit(self, nbytes, low_priority=False):
+        """Checks if uplink fits into all budgets, waiting first if throttled
+
+        :param int nbytes: payload bytes
+        :param bool low_priority:
+        :return: True if uplink may be sent
+        :rtype: bool
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                delay = self.__delay(nbytes, low_priority)
+                if delay is None or waited + delay > self.max_wait:
+                    self.rejected += 1
+                    return False
+
+                if delay <= 0:
+                    return True
+
+            time.sleep(delay)
+            waited += delay
+
+    def usage(self, period=DAY):
+        """Returns usage of the current window
+
+        :param int period: window length, e.g. HOUR or DAY
+        :rtype: Usage
+        """
+        with self._lock:
+            self.windows.setdefault(period, deque(maxlen=24))
+            return self.__window(period)
+
+    def remaining(self, budget):
+        """Returns how much of the budget is left in the current window
+
+        :param Budget budget:
+        :rtype: float
+        """
+        return budget.limit - getattr(self.usage(budget.period), budget.metric)
+
+    def __delay(self, nbytes, low_priority):
+        """Checks budgets for a single uplink
+
+        :param int nbytes: payload bytes
+        :param bool low_priority:
+        :return: None if low priority uplink does not fit, otherwise seconds to wait (0 to send now)
+        :rtype: float
+        """
+        now = time.time()
+        cost = {
+            PAYLOAD_BYTES: nbytes,
+            DATAGRAMS: 1,
+            RADIO_TIME: self.__radio_time(timer(), commit=False)
+        }
+
+        delay = 0.0
+        over_budget = False
+        for budget in self.budgets:
+            used = getattr(self.__window(budget.period, now), budget.metric) + cost[budget.metric]
+            if not low_priority:
+                over_budget = over_budget or used > budget.limit
+                continue
+
+            allowed = budget.limit * (1.0 - budget.reserve)
+            if used > allowed:
+                return None
+
+            if self.mode == THROTTLE and allowed > 0:
+                # time in the window at which the paced allowance reaches the usage before this send,
+                # so the first send of a window goes out immediately
+                elapsed = now % budget.period
+                delay = max(delay, (used - cost[budget.metric]) / allowed * budget.period - elapsed)
+
+        if over_budget:
+            self.over_budget += 1
+
+        return delay
+
+    def __radio_time(self, now, commit):
+        """Estimates radio connected time added by an uplink sent now
+
+        :param float now: timer value
+        :param bool commit: remember that the radio is connected
+        :rtype: float
+        """
+        added = self.radio_tail
+        if self._connected_until is not None and now < self._connected_until:
+            added = now + self.radio_tail - self._connected_until
+
+        if commit:
+            self._connected_until = now + self.radio_tail
+
+        return added
+
+    def __owners(self, socket, addr):
+        """Returns usages of the socket and destination
+
+        :param int socket: None to skip
+        :param (str, int) addr: None to skip
+        :rtype: list(Usage)
+        """
+        usages = []
+        if socket is not None:
+            usages.append(self.sockets.setdefault(socket, Usage()))
+        if addr is not None:
+            usages.append(self.destinations.setdefault((addr[0], int(addr[1])), Usage()))
+
+        return usages
+
+    def __current(self):
+        """Returns usages updated by every event: total and current windows
+
+        :rtype: list(Usage)
+        """
+        now = time.time()
+        return [self.total] + [self.__window(period, now) for period in self.windows]
+
+    def __window(self, period, now=None):
+        """Returns usage of the current window, starting new one if needed
+
+        :param int period:
+        :param float now: wall clock time
+        :rtype: Usage
+        """
+        if now is None:
+            now = time.time()
+
+        start = now - now % period
+        windows = self.windows[period]
+        if not windows or windows[-1][0] != start:
+            windows.append((start, Usage()))
+
+        return windows[-1][1]
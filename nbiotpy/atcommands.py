@@ -23,7 +23,7 @@ PREFIX = "AT+"
 POSTFIX = "\r\n"
 
 RADIO_ON = "CFUN=1"
-RADIO_OFF = "c"
+RADIO_OFF = "CFUN=0"
 REBOOT = "NRB"
 GPRS = "CGATT?"
 CGAC = "CGACT={}"
@@ -43,12 +43,26 @@ COAP = "UCOAP={}"
 COAPC = "UCOAPC={}"
 NPING = "NPING=\"{}\""
 USELCP = "USELCP=1"
+UESTATS = "NUESTATS"
+CSQ = "CSQ"
+NBAND = "NBAND={}"
+NBANDR = "NBAND?"
+NEARFCN = "NEARFCN=0,{}"
 
 MSG_TYPE = "1"
 
+# Maximal number of bytes accepted by a single NSOST command
+SOST_MAX_LEN = 512
+
 R_OK = "OK"
 R_ERROR = "ERROR"
 
+# Unsolicited result codes which may arrive while waiting for the response of another command
+URC_NPING = "\+NPING\:\s*\"?([^\",]+)\"?,(\d+),(\d+)"
+URC_NPINGERR = "\+NPINGERR\:\s*(\d+)"
+URC_PREFIXES = ("+NPING:", "+NPINGERR:", "+NSONMI:")
+URC_PING_PREFIXES = ("+NPING:", "+NPINGERR:")
+
 RESPONSE = {
     RADIO_ON: (R_OK, None),
     RADIO_OFF: (R_OK, None),
@@ -59,7 +73,7 @@ RESPONSE = {
     IMEI: (R_OK, "\+CGSN\:\s+(\d{15})"),
     IMSI: (R_OK, "(\d{15})"),
     SOST: (R_OK, None),
-    SORF: (R_OK, None),
+    SORF: (R_OK, "^\d+,\"?([^\",]+)\"?,(\d+),(\d+),\"?([0-9A-Fa-f]*)\"?,(\d+)"),
     CONS: (R_OK, None),
     SCONN: (R_OK, None),
     CGDCS: (R_OK, None),
@@ -70,5 +84,10 @@ RESPONSE = {
     COAP: (R_OK, None),
     COAPC: (R_OK, None),
     NPING: (R_OK, None),
-    USELCP: (R_OK, None)
+    USELCP: (R_OK, None),
+    UESTATS: (R_OK, None),
+    NBAND: (R_OK, None),
+    NBANDR: (R_OK, "\+NBAND\:\s*([\d,]+)"),
+    NEARFCN: (R_OK, None),
+    CSQ: (R_OK, "\+CSQ\:\s*(\d+),(\d+)")
 }
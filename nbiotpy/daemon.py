@@ -0,0 +1,442 @@
+# Copyright (C) 2018  Distributed Arctic Observatory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Local daemon sharing one modem between many processes
+
+The daemon owns the modem, keeps it attached and listens on a local UDP port or Unix datagram socket.
+Every local datagram starts with a single byte operation code:
+
+* ``U<seq>,<ip>:<port>\\n<payload>`` - send payload to the remote address, answered with ``A<seq>,1`` or
+  ``A<seq>,0``, where seq is any number chosen by the client to match answers with requests
+* ``R`` - register for downlinks that do not belong to any known sender
+* ``Q`` - query metrics, answered with ``Q<json>``
+
+Downlinks are delivered as ``D<ip>:<port>\\n<payload>`` to the local client which last sent to that
+remote address, or to all registered clients.
+
+When the modem fails to attach, the daemon keeps serving clients, queues uplinks and retries the attach
+every attach_interval seconds.
+"""
+
+import argparse
+import json
+import os
+import select
+import socket
+import shutil
+import tempfile
+import timeout_decorator
+from collections import deque
+from timeit import default_timer as timer
+from .nbiot import NbIoT
+from .netprofile import NetworkProfileStore
+
+DEFAULT_ADDRESS = "127.0.0.1:9900"
+
+OP_UPLINK = b"U"
+OP_REGISTER = b"R"
+OP_QUERY = b"Q"
+OP_ACK = b"A"
+OP_DOWNLINK = b"D"
+
+
+def parse_address(address):
+    """Converts local address string to socket family and address
+
+    :param str address: "host:port" for UDP or path of the Unix socket
+    :rtype: (int, object)
+    """
+    if address.startswith('/') or address.startswith('.'):
+        return socket.AF_UNIX, address
+
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+
+def encode_datagram(op, addr, payload, seq=None):
+    """Builds datagram carrying payload for/from the remote address
+
+    :param bytes op: OP_UPLINK or OP_DOWNLINK
+    :param (str, int) addr: remote (ip_address, port)
+    :param bytes payload:
+    :param int seq: request sequence number, used by uplinks
+    :rtype: bytes
+    """
+    header = "{}:{}\n".format(addr[0], addr[1])
+    if seq is not None:
+        header = "{},{}".format(seq, header)
+
+    return op + header.encode() + payload
+
+
+def decode_datagram(datagram):
+    """Splits datagram built by encode_datagram
+
+    :param bytes datagram:
+    :return: remote (ip_address, port), payload and sequence number (None if not present)
+    :rtype: ((str, int), bytes, int)
+    """
+    header, payload = datagram[1:].split(b"\n", 1)
+    header = header.decode()
+    seq = None
+    if ',' in header:
+        seq, header = header.split(',', 1)
+        seq = int(seq)
+    host, port = header.rsplit(':', 1)
+
+    return (host, int(port)), payload, seq
+
+
+def encode_ack(seq, status):
+    """Builds answer to the uplink request
+
+    :param int seq: request sequence number
+    :param bool status: operation status
+    :rtype: bytes
+    """
+    return OP_ACK + "{},{}".format(seq, 1 if status else 0).encode()
+
+
+class Daemon:
+    """Forwards datagrams between local clients and the modem
+
+    :ivar NbIoT nb: modem owned by the daemon
+    :ivar socket.socket sock: local socket
+    :ivar int max_queue: maximal number of uplinks waiting for the modem
+    :ivar float poll_interval: seconds between downlink checks
+    :ivar float attach_interval: seconds between attach checks
+    :ivar deque queue: (client, sequence number, remote address, payload) waiting to be sent
+    :ivar dict routes: remote address -> local client which last sent to it
+    :ivar set subscribers: local clients registered for downlinks
+    :ivar dict metrics: counters reported to clients
+    :ivar bool connected: modem is connected to the network
+    """
+
+    def __init__(self, nb, address=DEFAULT_ADDRESS, max_queue=256, poll_interval=10.0, attach_interval=60.0):
+        """
+        :param NbIoT nb:
+        :param str address: see parse_address
+        :param int max_queue:
+        :param float poll_interval:
+        :param float attach_interval:
+        """
+        self.nb = nb
+        self.max_queue = max_queue
+        self.poll_interval = poll_interval
+        self.attach_interval = attach_interval
+
+        family, self._address = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(self._address):
+            os.unlink(self._address)
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.bind(self._address)
+
+        self.queue = deque()
+        self.routes = {}
+        self.subscribers = set()
+        self.metrics = {
+            'queue_depth': 0,
+            'max_queue_depth': 0,
+            'uplinks': 0,
+            'uplink_errors': 0,
+            'dropped': 0,
+            'downlinks': 0,
+            'unrouted': 0,
+            'reconnects': 0,
+            'connect_errors': 0
+        }
+        self.connected = False
+        self._running = False
+
+    def run(self):
+        """Connects the modem and serves clients until stop() is called
+
+        Failed attach does not stop the daemon, uplinks are queued until the next attempt succeeds.
+        """
+        self._running = True
+        next_poll = timer()
+        next_attach_check = timer() + self.attach_interval
+
+        try:
+            self.__connect()
+            while self._running:
+                now = timer()
+                timeout = max(0.0, min(next_poll, next_attach_check) - now)
+                if self.queue and self.connected:
+                    timeout = 0
+                readable, _, _ = select.select([self.sock], [], [], timeout)
+                if readable:
+                    self.__accept()
+
+                # one uplink per iteration, so local clients are served between slow AT commands
+                if self.queue and self.connected:
+                    self.__forward()
+
+                now = timer()
+                if now >= next_poll:
+                    if self.connected:
+                        self.__poll_downlinks()
+                    next_poll = now + self.poll_interval
+
+                if now >= next_attach_check:
+                    self.__keep_attached()
+                    next_attach_check = timer() + self.attach_interval
+        finally:
+            self.nb.disconnect()
+            self.sock.close()
+            if isinstance(self._address, str) and os.path.exists(self._address):
+                os.unlink(self._address)
+
+    def stop(self):
+        """Makes run() return after the current iteration
+        """
+        self._running = False
+
+    def __accept(self):
+        """Reads all pending local datagrams
+        """
+        while True:
+            try:
+                datagram, client = self.sock.recvfrom(65535, socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return
+
+            if not datagram:
+                continue
+
+            op = datagram[:1]
+            if op == OP_UPLINK:
+                try:
+                    addr, payload, seq = decode_datagram(datagram)
+                except ValueError:
+                    # without sequence number the client cannot match the answer anyway
+                    continue
+
+                if len(self.queue) >= self.max_queue:
+                    self.metrics['dropped'] += 1
+                    self.__reply(encode_ack(seq, False), client)
+                    continue
+
+                self.queue.append((client, seq, addr, payload))
+                self.metrics['max_queue_depth'] = max(self.metrics['max_queue_depth'], len(self.queue))
+            elif op == OP_REGISTER:
+                self.subscribers.add(client)
+            elif op == OP_QUERY:
+                self.metrics['queue_depth'] = len(self.queue)
+                self.__reply(OP_QUERY + json.dumps(self.metrics).encode(), client)
+
+    def __forward(self):
+        """Sends the oldest queued uplink through the modem
+        """
+        client, seq, addr, payload = self.queue.popleft()
+        status = self.nb.send_to(payload, addr)
+
+        if status:
+            self.metrics['uplinks'] += 1
+            self.routes[addr] = client
+        else:
+            self.metrics['uplink_errors'] += 1
+
+        self.__reply(encode_ack(seq, status), client)
+
+    def __poll_downlinks(self):
+        """Reads all datagrams waiting in the modem and routes them to local clients
+        """
+        while True:
+            status, payload, addr = self.nb.receive_from()
+            if not status or payload is None:
+                return
+
+            self.metrics['downlinks'] += 1
+            datagram = encode_datagram(OP_DOWNLINK, addr, payload)
+            client = self.routes.get(addr)
+            targets = [client] if client is not None else list(self.subscribers)
+            if not targets:
+                self.metrics['unrouted'] += 1
+
+            for target in targets:
+                self.__reply(datagram, target)
+
+    def __connect(self):
+        """Connects the modem, failed attach is retried by __keep_attached
+
+        :return: connection status
+        :rtype: bool
+        """
+        try:
+            self.nb.connect()
+        except timeout_decorator.TimeoutError:
+            self.metrics['connect_errors'] += 1
+            self.connected = False
+            return False
+
+        self.connected = True
+        return True
+
+    def __keep_attached(self):
+        """Reconnects the modem when it is not connected or lost the network
+        """
+        if self.connected and self.nb.is_attached():
+            return
+
+        self.metrics['reconnects'] += 1
+        self.nb.disconnect()
+        self.__connect()
+
+    def __reply(self, datagram, client):
+        """Sends datagram to local client, ignoring clients that went away
+
+        :param bytes datagram:
+        :param object client: client address
+        """
+        try:
+            self.sock.sendto(datagram, client)
+        except OSError:
+            self.subscribers.discard(client)
+
+
+class DaemonClient:
+    """Talks to the Daemon from another process
+
+    :ivar socket.socket sock: local socket connected to the daemon
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=30.0):
+        """
+        :param str address: daemon address, see parse_address
+        :param float timeout: seconds to wait for daemon answers
+        """
+        family, daemon_address = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self._dir = None
+
+        if family == socket.AF_UNIX:
+            # Unix datagram sockets need own address to get answers, private directory avoids name races
+            self._dir = tempfile.mkdtemp(prefix='nbiotpy-')
+            self.sock.bind(os.path.join(self._dir, 'client.sock'))
+
+        self.sock.connect(daemon_address)
+        self.sock.settimeout(timeout)
+        self._downlinks = deque()
+        self._seq = 0
+
+    def send_to(self, data, addr, wait=True):
+        """Sends data to a specific address through the daemon
+
+        :param str|bytes data: data to send
+        :param (str, int) addr: (ip_address, port)
+        :param bool wait: wait until the modem sent the data
+        :return: operation status, always True when not waiting
+        :rtype: bool
+        """
+        if isinstance(data, str):
+            data = data.encode()
+
+        self._seq += 1
+        seq = self._seq
+        self.sock.send(encode_datagram(OP_UPLINK, addr, data, seq))
+        if not wait:
+            return True
+
+        # answers to earlier requests sent without waiting are skipped
+        expected = "{},".format(seq).encode()
+        while True:
+            ack = self.__receive(OP_ACK)
+            if ack[1:].startswith(expected):
+                return ack[len(expected) + 1:] == b"1"
+
+    def register(self):
+        """Asks the daemon for downlinks not addressed to any other client
+        """
+        self.sock.send(OP_REGISTER)
+
+    def receive_from(self):
+        """Waits for a downlink
+
+        :return: received data and (ip_address, port) of the sender
+        :rtype: (bytes, (str, int))
+        """
+        if self._downlinks:
+            datagram = self._downlinks.popleft()
+        else:
+            datagram = self.__receive(OP_DOWNLINK)
+
+        addr, payload, _ = decode_datagram(datagram)
+        return payload, addr
+
+    def get_metrics(self):
+        """Returns daemon metrics, e.g. queue depth
+
+        :rtype: dict
+        """
+        self.sock.send(OP_QUERY)
+
+        return json.loads(self.__receive(OP_QUERY)[1:].decode())
+
+    def close(self):
+        """Closes the local socket
+        """
+        self.sock.close()
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+    def __receive(self, op):
+        """Waits for datagram with given operation code, keeping downlinks received meanwhile
+
+        :param bytes op:
+        :rtype: bytes
+        """
+        while True:
+            datagram = self.sock.recv(65535)
+            if datagram[:1] == op:
+                return datagram
+
+            if datagram[:1] == OP_DOWNLINK:
+                self._downlinks.append(datagram)
+
+
+def main():
+    """Entry point of the nbiotpy console command
+    """
+    parser = argparse.ArgumentParser(description='Shares NB-IoT modem between local processes')
+    parser.add_argument('-l', '--listen', help='Local UDP host:port or Unix socket path', default=DEFAULT_ADDRESS)
+    parser.add_argument('-d', '--device', help='Modem serial port', default='/dev/ttyACM0')
+    parser.add_argument('--apn', help='Access Point Name', default='telenor.iot')
+    parser.add_argument('--mccmnc', help='Mobile Country Code and Mobile Network Code', type=int, default=24201)
+    parser.add_argument('--port', help='Modem socket port', type=int, default=9000)
+    parser.add_argument('--bands', help='Comma separated LTE bands to search, e.g. 8,20')
+    parser.add_argument('--profile', help='JSON file with learned network profiles')
+    parser.add_argument('--queue', help='Maximal number of queued uplinks', type=int, default=256)
+    parser.add_argument('--poll', help='Seconds between downlink checks', type=float, default=10.0)
+    parser.add_argument('--debug', help='Print modem communication', action='store_true')
+    args = parser.parse_args()
+
+    bands = [int(band) for band in args.bands.split(',')] if args.bands else None
+    profiles = NetworkProfileStore(args.profile) if args.profile else None
+
+    nb = NbIoT(serial_port=args.device, apn=args.apn, mccmnc=args.mccmnc, socket_port=args.port, debug=args.debug,
+               bands=bands, profiles=profiles)
+    daemon = Daemon(nb, address=args.listen, max_queue=args.queue, poll_interval=args.poll)
+
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
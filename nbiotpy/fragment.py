@@ -0,0 +1,246 @@
+# Copyright (C) 2018  Distributed Arctic Observatory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Fragmentation and reassembly of payloads bigger than a single NSOST datagram
+
+Every fragment starts with a 7 byte header followed by a slice of the payload::
+
+    +-------+------------+-------+-------+
+    | magic | message id | index | count |
+    | 1 B   | 2 B        | 2 B   | 2 B   |
+    +-------+------------+-------+-------+
+
+All fields are unsigned big endian integers, ``index`` is zero based.
+"""
+
+import struct
+import itertools
+from collections import OrderedDict
+from timeit import default_timer as timer
+
+FRAG_MAGIC = 0xA5
+FRAG_HEADER = struct.Struct(">BHHH")
+FRAG_MAX_COUNT = 0xFFFF
+
+
+def split_payload(data, msg_id, mtu):
+    """Splits data into datagrams with fragment header
+
+    :param bytes data: payload to split
+    :param int msg_id: message id (truncated to 16 bits)
+    :param int mtu: maximal size of a single datagram including header
+    :return: list of datagrams ready to send
+    :rtype: list(bytes)
+    """
+    chunk_size = mtu - FRAG_HEADER.size
+    if chunk_size <= 0:
+        raise ValueError("MTU must be bigger than fragment header ({} bytes)".format(FRAG_HEADER.size))
+
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)] or [b""]
+    count = len(chunks)
+    if count > FRAG_MAX_COUNT:
+        raise ValueError("Payload too big: {} fragments, max {}".format(count, FRAG_MAX_COUNT))
+
+    msg_id &= 0xFFFF
+    return [FRAG_HEADER.pack(FRAG_MAGIC, msg_id, i, count) + chunk for i, chunk in enumerate(chunks)]
+
+
+def parse_fragment(datagram):
+    """Splits datagram into header fields and payload
+
+    :param bytes datagram: received datagram
+    :return: (msg_id, index, count, payload) or None if datagram is not a valid fragment
+    :rtype: (int, int, int, bytes)
+    """
+    if len(datagram) < FRAG_HEADER.size:
+        return None
+
+    magic, msg_id, index, count = FRAG_HEADER.unpack_from(datagram)
+    if magic != FRAG_MAGIC or count == 0 or index >= count:
+        return None
+
+    return msg_id, index, count, bytes(datagram[FRAG_HEADER.size:])
+
+
+class MessageIdGenerator:
+    """Generates 16 bit message ids used in fragment headers
+
+    :ivar itertools.count _counter: source of consecutive ids
+    """
+
+    def __init__(self, start=0):
+        """
+        :param int start: first generated id
+        """
+        self._counter = itertools.count(start)
+
+    def next(self):
+        """Returns next message id
+
+        :rtype: int
+        """
+        return next(self._counter) & 0xFFFF
+
+
+class Reassembler:
+    """Collects fragments and returns complete payloads
+
+    Fragments may arrive out of order and duplicated. Partial messages are dropped when no new fragment
+    arrived for ``timeout`` seconds or when more than ``max_messages`` of them are in progress (the least
+    recently active goes first), so memory stays bounded by ``max_messages * max_bytes``. Keys of recently completed messages
+    are remembered for ``timeout`` seconds (at most ``max_completed`` of them), so late duplicates of their
+    fragments are counted as duplicates instead of starting new partial messages. Every drop is reported to
+    the optional ``on_drop(source, msg_id, missing)`` callback with the number of fragments never received.
+
+    :ivar int max_messages: maximal number of partial messages kept at the same time
+    :ivar int max_bytes: maximal size of a single reassembled message
+    :ivar int max_completed: maximal number of remembered completed messages
+    :ivar float timeout: seconds without new fragment after which partial message is dropped
+    :ivar int dropped: number of partial messages dropped so far
+    :ivar int duplicates: number of duplicated fragments seen so far
+    :ivar callable on_drop: called with (source, msg_id, missing fragments) when partial message is dropped
+    :ivar OrderedDict _partial: partial messages keyed by (source, msg_id), the least recently active first
+    :ivar OrderedDict _completed: (source, msg_id) -> (completion time, fragment count), the oldest first
+    """
+
+    def __init__(self, max_messages=16, max_bytes=64 * 1024, timeout=60.0, max_completed=None, on_drop=None):
+        """
+        :param int max_messages:
+        :param int max_bytes:
+        :param float timeout:
+        :param int max_completed: defaults to 4 * max_messages
+        :param callable on_drop:
+        """
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_completed = max_completed if max_completed is not None else 4 * max_messages
+        self.timeout = timeout
+        self.dropped = 0
+        self.duplicates = 0
+        self.on_drop = on_drop
+
+        self._partial = OrderedDict()
+        self._completed = OrderedDict()
+
+    def feed(self, datagram, source=None):
+        """Adds single datagram to the reassembler
+
+        :param bytes datagram: received datagram
+        :param object source: sender identifier, e.g. (ip_address, port), keeps message ids of senders apart
+        :return: complete payload when the last missing fragment arrives, None otherwise
+        :rtype: bytes
+        """
+        now = timer()
+        self.expire(now)
+
+        parsed = parse_fragment(datagram)
+        if parsed is None:
+            return None
+
+        msg_id, index, count, payload = parsed
+        if count == 1:
+            return payload
+
+        key = (source, msg_id)
+        completed = self._completed.get(key)
+        if completed is not None:
+            if completed[1] == count:
+                self.duplicates += 1
+                return None
+            # message id reused for a different message
+            del self._completed[key]
+
+        entry = self._partial.get(key)
+        if entry is not None and entry[1] != count:
+            # message id reused for a different message, previous one is lost
+            self.__drop(key)
+            entry = None
+
+        if entry is None:
+            while len(self._partial) >= self.max_messages:
+                self.__drop(next(iter(self._partial)))
+            # [last seen, fragment count, size so far, fragments]
+            entry = [now, count, 0, {}]
+            self._partial[key] = entry
+
+        fragments = entry[3]
+        if index in fragments:
+            self.duplicates += 1
+            return None
+
+        entry[2] += len(payload)
+        fragments[index] = payload
+        if entry[2] > self.max_bytes:
+            self.__drop(key)
+            return None
+
+        # timeout measures idle time, a long message on a slow link may take longer than timeout in total
+        entry[0] = now
+        self._partial.move_to_end(key)
+
+        if len(fragments) < count:
+            return None
+
+        del self._partial[key]
+        self._completed[key] = (now, count)
+        while len(self._completed) > self.max_completed:
+            self._completed.popitem(last=False)
+
+        return b"".join(fragments[i] for i in range(count))
+
+    def expire(self, now=None):
+        """Drops partial messages idle for longer than timeout
+
+        :param float now: current timer value
+        :return: number of dropped messages
+        :rtype: int
+        """
+        if now is None:
+            now = timer()
+
+        # partial messages are kept in order of the last fragment, so the idle ones are at the front
+        expired = 0
+        while self._partial:
+            key, entry = next(iter(self._partial.items()))
+            if now - entry[0] < self.timeout:
+                break
+            self.__drop(key)
+            expired += 1
+
+        while self._completed:
+            key, completed = next(iter(self._completed.items()))
+            if now - completed[0] < self.timeout:
+                break
+            del self._completed[key]
+
+        return expired
+
+    def pending(self):
+        """Returns number of partial messages
+
+        :rtype: int
+        """
+        return len(self._partial)
+
+    def __drop(self, key):
+        """Removes partial message and counts it as dropped
+
+        :param (object, int) key: (source, msg_id) of the message
+        """
+        entry = self._partial.pop(key)
+        self.dropped += 1
+        if self.on_drop is not None:
+            self.on_drop(key[0], key[1], entry[1] - len(entry[3]))
@@ -0,0 +1,254 @@
+# Copyright (C) 2018  Distributed Arctic Observatory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Radio link quality sampling and signal aware sending
+"""
+
+import time
+from collections import deque, namedtuple
+from timeit import default_timer as timer
+
+LinkSample = namedtuple('LinkSample', ['timestamp', 'rsrp', 'snr', 'ecl', 'rssi', 'cell_id', 'earfcn', 'pci'])
+LinkSample.__doc__ = """Single link quality measurement
+
+:ivar float timestamp: timer value when the sample was taken
+:ivar float rsrp: reference signal received power in dBm
+:ivar float snr: signal to noise ratio in dB
+:ivar int ecl: coverage enhancement level (0, 1 or 2)
+:ivar int rssi: received signal strength in dBm from CSQ
+:ivar int cell_id: serving cell id
+:ivar int earfcn: serving cell EARFCN
+:ivar int pci: serving cell physical cell id
+"""
+
+# CSQ reports 99 when signal strength is not known
+CSQ_UNKNOWN = 99
+
+
+def csq_to_dbm(rssi):
+    """Converts CSQ rssi index to dBm
+
+    :param int rssi: rssi index reported by CSQ
+    :return: signal strength in dBm or None if not known
+    :rtype: int
+    """
+    if rssi is None or rssi == CSQ_UNKNOWN:
+        return None
+
+    return -113 + 2 * rssi
+
+
+def _tenths(value):
+    """Converts value reported in tenths of unit to float
+
+    :param int value: value from NUESTATS
+    :rtype: float
+    """
+    if not isinstance(value, int):
+        return None
+
+    return value / 10.0
+
+
+class LinkSampler:
+    """Periodically reads link quality from the modem into a ring buffer
+
+    The sampler does not run on its own, the modem is queried only from sample() and poll(), so it never
+    interleaves with other AT commands.
+
+    :ivar NbIoT nb: connected modem
+    :ivar float interval: minimal number of seconds between two samples taken by poll()
+    :ivar deque samples: ring buffer with the last LinkSample objects
+    """
+
+    def __init__(self, nb, interval=60.0, size=120):
+        """
+        :param NbIoT nb:
+        :param float interval:
+        :param int size: capacity of the ring buffer
+        """
+        self.nb = nb
+        self.interval = interval
+        self.samples = deque(maxlen=size)
+
+    def sample(self):
+        """Queries the modem and stores new sample
+
+        :return: new sample or None if the modem did not answer properly
+        :rtype: LinkSample
+        """
+        if not self.nb.get_radio_stats():
+            return None
+
+        stats = self.nb.radio_stats
+        rssi = None
+        if self.nb.get_signal_quality() and self.nb.csq is not None:
+            rssi = csq_to_dbm(self.nb.csq[0])
+
+        sample = LinkSample(
+            timestamp=timer(),
+            rsrp=_tenths(stats.get('signal_power')),
+            snr=_tenths(stats.get('snr')),
+            ecl=stats.get('ecl'),
+            rssi=rssi,
+            cell_id=stats.get('cell_id'),
+            earfcn=stats.get('earfcn'),
+            pci=stats.get('pci')
+        )
+        self.samples.append(sample)
+
+        return sample
+
+    def poll(self, max_age=None):
+        """Takes new sample only if the latest one is older than max_age
+
+        :param float max_age: seconds, defaults to interval
+        :return: the latest sample
+        :rtype: LinkSample
+        """
+        if max_age is None:
+            max_age = self.interval
+
+        latest = self.latest()
+        if latest is None or timer() - latest.timestamp >= max_age:
+            return self.sample() or latest
+
+        return latest
+
+    def latest(self):
+        """Returns the latest sample
+
+        :rtype: LinkSample
+        """
+        if not self.samples:
+            return None
+
+        return self.samples[-1]
+
+    def history(self, since=None):
+        """Returns samples from the ring buffer
+
+        :param float since: only samples taken at or after this timer value
+        :rtype: list(LinkSample)
+        """
+        if since is None:
+            return list(self.samples)
+
+        return [s for s in self.samples if s.timestamp >= since]
+
+    def average(self, field, count=None):
+        """Averages given field over the latest samples, skipping unknown values
+
+        :param str field: LinkSample field name, e.g. 'rsrp'
+        :param int count: number of latest samples, all by default
+        :rtype: float
+        """
+        samples = list(self.samples)
+        if count is not None:
+            samples = samples[-count:]
+
+        values = [getattr(s, field) for s in samples if getattr(s, field) is not None]
+        if not values:
+            return None
+
+        return sum(values) / float(len(values))
+
+
+class SignalGate:
+    """Defers non urgent uplinks until link quality is good enough
+
+    Sends immediately when the link is good or the message is urgent, otherwise waits, re-sampling every
+    retry_interval seconds, until the link gets good or max_deferral seconds pass.
+
+    :ivar NbIoT nb: connected modem
+    :ivar LinkSampler sampler: source of link quality
+    :ivar float min_rsrp: minimal RSRP in dBm, None to ignore
+    :ivar float min_snr: minimal SNR in dB, None to ignore
+    :ivar int max_ecl: maximal coverage enhancement level, None to ignore
+    :ivar float max_deferral: maximal number of seconds a message can be deferred
+    :ivar float retry_interval: seconds between link quality checks while deferring
+    """
+
+    def __init__(self, nb, sampler=None, min_rsrp=None, min_snr=None, max_ecl=1, max_deferral=600.0,
+                 retry_interval=30.0):
+        """
+        :param NbIoT nb:
+        :param LinkSampler sampler: created for nb if not given
+        :param float min_rsrp:
+        :param float min_snr:
+        :param int max_ecl:
+        :param float max_deferral:
+        :param float retry_interval:
+        """
+        self.nb = nb
+        self.sampler = sampler if sampler is not None else LinkSampler(nb)
+        self.min_rsrp = min_rsrp
+        self.min_snr = min_snr
+        self.max_ecl = max_ecl
+        self.max_deferral = max_deferral
+        self.retry_interval = retry_interval
+
+    def is_good(self, sample):
+        """Checks if sample satisfies all thresholds
+
+        :param LinkSample sample:
+        :rtype: bool
+        """
+        if sample is None:
+            return False
+
+        if self.max_ecl is not None and (sample.ecl is None or sample.ecl > self.max_ecl):
+            return False
+
+        if self.min_rsrp is not None and (sample.rsrp is None or sample.rsrp < self.min_rsrp):
+            return False
+
+        if self.min_snr is not None and (sample.snr is None or sample.snr < self.min_snr):
+            return False
+
+        return True
+
+    def wait(self):
+        """Blocks until the link is good or max_deferral passes
+
+        :return: True if the link is good, False if the deferral time ran out
+        :rtype: bool
+        """
+        deadline = timer() + self.max_deferral
+
+        while True:
+            if self.is_good(self.sampler.poll(self.retry_interval)):
+                return True
+
+            remaining = deadline - timer()
+            if remaining <= 0:
+                return False
+
+            time.sleep(min(self.retry_interval, remaining))
+
+    def send_to(self, data, addr, urgent=False):
+        """Sends data through NbIoT.send_to, deferring it first unless urgent
+
+        :param str|bytes data: data to send
+        :param (str, int) addr: (ip_address, port)
+        :param bool urgent: send without checking link quality
+        :return: operation status
+        :rtype: bool
+        """
+        if not urgent:
+            self.wait()
+
+        return self.nb.send_to(data, addr)
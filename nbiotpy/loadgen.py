@@ -0,0 +1,135 @@
+# Copyright (C) 2018  Distributed Arctic Observatory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Load generator for the ingestion server
+
+Simulates many devices, each with its own UDP socket, uploading random files with the file transfer
+protocol or with fragmented payloads, optionally losing and reordering datagrams.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+from timeit import default_timer as timer
+from .fragment import split_payload
+from .server import encode_file
+from .atcommands import SOST_MAX_LEN
+
+
+class _Sender(asyncio.DatagramProtocol):
+    """Datagram protocol ignoring everything received
+    """
+    pass
+
+
+async def run_device(addr, index, files, size, part_size, rate, fragmented, loss, reorder):
+    """Uploads files from a single simulated device
+
+    :param (str, int) addr: server address
+    :param int index: device number, used in file names
+    :param int files: number of files to upload
+    :param int size: file size in bytes
+    :param int part_size: raw bytes per part
+    :param float rate: datagrams per second, 0 for no limit
+    :param bool fragmented: use fragmented payloads instead of the file transfer protocol
+    :param float loss: probability of dropping a datagram
+    :param float reorder: probability of swapping a datagram with the next one
+    :return: (datagrams, bytes) sent
+    :rtype: (int, int)
+    """
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(_Sender, remote_addr=addr)
+    sent = 0
+    sent_bytes = 0
+
+    if rate:
+        # spread devices over the sending period instead of waking them all at once
+        await asyncio.sleep(random.random() / rate)
+
+    try:
+        for n in range(files):
+            data = os.urandom(size)
+            if fragmented:
+                datagrams = split_payload(data, n, part_size)
+            else:
+                datagrams = [m.encode() for m in encode_file("device{}-{}.bin".format(index, n), data, part_size)]
+
+            for i in range(len(datagrams) - 1):
+                if random.random() < reorder:
+                    datagrams[i], datagrams[i + 1] = datagrams[i + 1], datagrams[i]
+
+            for datagram in datagrams:
+                if random.random() >= loss:
+                    transport.sendto(datagram)
+                    sent += 1
+                    sent_bytes += len(datagram)
+
+                # yield to other devices even without rate limit
+                await asyncio.sleep(1.0 / rate if rate else 0)
+    finally:
+        transport.close()
+
+    return sent, sent_bytes
+
+
+async def run(addr, devices, files, size, part_size, rate, fragmented, loss, reorder):
+    """Runs all simulated devices and prints the totals
+
+    :param (str, int) addr: server address
+    :param int devices: number of devices
+
+    Remaining parameters are passed to run_device.
+    """
+    start = timer()
+    results = await asyncio.gather(*[
+        run_device(addr, i, files, size, part_size, rate, fragmented, loss, reorder) for i in range(devices)
+    ])
+    elapsed = timer() - start
+
+    datagrams = sum(r[0] for r in results)
+    sent_bytes = sum(r[1] for r in results)
+    print("sent {} datagrams, {} bytes in {:.2f}s ({:.0f} datagrams/s, {:.0f} B/s)".format(
+        datagrams, sent_bytes, elapsed, datagrams / elapsed, sent_bytes / elapsed))
+
+
+def main():
+    """Entry point of the load generator
+    """
+    parser = argparse.ArgumentParser(description='Benchmarks the ingestion server with simulated devices')
+    parser.add_argument('--host', help='Server address', default='127.0.0.1')
+    parser.add_argument('--port', help='Server UDP port', type=int, default=9000)
+    parser.add_argument('-d', '--devices', help='Number of simulated devices', type=int, default=1000)
+    parser.add_argument('-f', '--files', help='Files uploaded by every device', type=int, default=1)
+    parser.add_argument('-s', '--size', help='File size in bytes', type=int, default=10000)
+    parser.add_argument('-p', '--part-size', help='Bytes per part', type=int, default=200)
+    parser.add_argument('-r', '--rate', help='Datagrams per second per device, 0 for no limit', type=float,
+                        default=10)
+    parser.add_argument('--fragmented', help='Send fragmented payloads instead of files', action='store_true')
+    parser.add_argument('--loss', help='Probability of dropping a datagram', type=float, default=0.0)
+    parser.add_argument('--reorder', help='Probability of swapping neighbouring datagrams', type=float, default=0.0)
+    args = parser.parse_args()
+
+    part_size = args.part_size
+    if args.fragmented:
+        part_size = min(part_size, SOST_MAX_LEN)
+
+    asyncio.run(run((args.host, args.port), args.devices, args.files, args.size, part_size, args.rate,
+                    args.fragmented, args.loss, args.reorder))
+
+
+if __name__ == '__main__':
+    main()
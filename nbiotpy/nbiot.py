@@ -18,45 +18,91 @@ import time
 import re
 import binascii
 import timeout_decorator
+from collections import deque
 from timeit import default_timer as timer
 from .atcommands import *
+from .fragment import split_payload, MessageIdGenerator
+from .netprofile import band_from_earfcn
 
 
 class NbIoT:
     """Class responsible for interaction with SARA-N210 modem
 
-    :ivar serial.Serial serial: pyserial object for communication with the modem
+    :ivar serial.Serial serial: pyserial object (or any transport from transport.py) for communication with the modem
     :ivar int socket: socket number returned by the network operator
     :ivar int imei: International Mobile Equipment Identity
     :ivar int imsi: International Mobile Subscriber Identity)
     :ivar int mccmnc: Mobile Country Code and Mobile Network Code
     :ivar str apn: Access Point Name
+    :ivar Accountant accountant: collects traffic statistics and enforces budgets, may be None
+    :ivar dict radio_stats: last radio statistics reported by NUESTATS, e.g. {'signal_power': -745, 'ecl': 0}
+    :ivar (int, int) csq: last (rssi, ber) reported by CSQ
     :ivar int port: Port number to create the socket
+    :ivar list(int) bands: LTE bands the modem searches, None to keep the modem configuration
+    :ivar list(int) modem_bands: bands configured in the modem before connect narrowed them, read by get_bands
+    :ivar int earfcn: EARFCN the modem is locked to, None to search all
+    :ivar int pci: physical cell id the modem is locked to together with earfcn
+    :ivar NetworkProfileStore profiles: learned profiles tried before full cell search, may be None
+    :ivar str site: key of the learned profile, defaults to mccmnc
+    :ivar float attach_time: seconds the last attach took
     :ivar str _cmd: Stores simple AT command that will be send via serial to the modem
     :ivar str _complex_cmd: Stores complex AT command (usually with input parameters) that will be send via serial to the modem
+    :ivar list(str) _response: all lines of the last modem response
+    :ivar (int, (str, int)) _traffic_owner: (socket, destination) serial traffic is accounted to, None for
+        modem management
+    :ivar deque _urc: urcs received while reading responses of other commands
+    :ivar MessageIdGenerator _msg_ids: source of message ids for fragmented payloads
     :ivar bool _debug: Indicates whether to display debug messages from the class or not
     """
 
-    def __init__(self, serial_port='/dev/ttyACM0', apn='telenor.iot', mccmnc=24201, socket_port=9000, debug=False):
+    def __init__(self, serial_port='/dev/ttyACM0', apn='telenor.iot', mccmnc=24201, socket_port=9000, debug=False,
+                 transport=None, accountant=None, bands=None, earfcn=None, pci=None, profiles=None, site=None,
+                 learned_timeout=60):
         """
         :param serial.Serial serial_port:
         :param str apn:
         :param int mccmnc:
         :param int socket_port:
         :param bool debug:
-        """
-
-        self.serial = serial.Serial(serial_port, 9600, 5.0)
+        :param object transport: object with write() and readline() used instead of opening serial_port,
+            e.g. RecordingTransport or ReplayTransport
+        :param Accountant accountant:
+        :param list(int) bands:
+        :param int earfcn:
+        :param int pci:
+        :param NetworkProfileStore profiles:
+        :param str site:
+        :param int learned_timeout: seconds to wait for attach with learned profile before full cell search
+        """
+
+        if transport is None:
+            transport = serial.Serial(serial_port, 9600, 5.0)
+        self.serial = transport
+        self.accountant = accountant
         self.socket = -1
         self.imei = None
         self.imsi = None
+        self.radio_stats = {}
+        self.csq = None
         # Mobile Country Code and Mobile Network Code
         self.mccmnc = mccmnc
         self.apn = apn
         self.port = socket_port
-
+        self.bands = bands
+        self.modem_bands = None
+        self.earfcn = earfcn
+        self.pci = pci
+        self.profiles = profiles
+        self.site = site if site is not None else str(mccmnc)
+        self.attach_time = None
+
+        self._learned_timeout = learned_timeout
         self._cmd = None
         self._complex_cmd = None
+        self._response = []
+        self._traffic_owner = None
+        self._urc = deque(maxlen=64)
+        self._msg_ids = MessageIdGenerator()
         self._debug = debug
 
     def __log(self, msg):
@@ -67,24 +113,69 @@ class NbIoT:
         if self._debug:
             print(msg)
 
+    def __now(self):
+        """Returns current time from the transport clock if it has one (see transport.py)
+
+        :rtype: float
+        """
+        now = getattr(self.serial, 'now', None)
+
+        return now() if now is not None else timer()
+
+    def __sleep(self, seconds):
+        """Sleeps using the transport clock if it has one (see transport.py)
+
+        :param float seconds:
+        """
+        sleep = getattr(self.serial, 'sleep', None)
+        if sleep is not None:
+            sleep(seconds)
+        else:
+            time.sleep(seconds)
+
     def connect(self):
         """Connects modem to the network operator
 
         Performs the following steps to get modem connected to the operator:
         * reboots the modem to have errors free state
+        * limits the search to configured bands and EARFCN, or to the learned profile of the site
         * changes the status of modem radio to enabled
         * sets the operator mccmnc data
         * activates the operator APN
         * creates socket at the operators side
 
+        When attach with the learned profile does not succeed in learned_timeout seconds, the modem is
+        rebooted and searches all configured bands. The band list is kept in the modem NVM, so without
+        configured bands the list read before the learned attempt is restored. Serving cell of every
+        successful attach is saved to the profiles together with that list.
+
         """
-        self.reboot()
-        self.__radio_on()
-        self.__set_apn()
-        self.__select_operator()
-        self.__check_if_attached()
+        start = self.__now()
+        learned = self.profiles.get(self.site) if self.profiles is not None and self.earfcn is None else None
+
+        if self.profiles is not None and self.bands is None and self.modem_bands is None:
+            # after a successful learned attach the modem keeps only the learned band, the profile knows better
+            self.modem_bands = learned.get('modem_bands') if learned is not None else None
+            if self.modem_bands is None:
+                self.get_bands()
+
+        attached = False
+        if learned is not None:
+            self.__log("### LEARNED PROFILE: {} ###".format(learned))
+            bands = [learned['band']] if learned.get('band') is not None else self.bands
+            attached = self.__attach(bands, learned.get('earfcn'), learned.get('pci'), self._learned_timeout,
+                                     fallback_on_timeout=True)
+
+        if not attached:
+            bands = self.bands
+            if bands is None and learned is not None and learned.get('band') is not None:
+                bands = self.modem_bands
+            self.__attach(bands, self.earfcn, self.pci, 180, fallback_on_timeout=False)
+
+        self.attach_time = self.__now() - start
         self.__activate_pdp_context()
         self.__create_socket()
+        self.__learn_profile()
 
     def disconnect(self):
         """Closes socket at the operator side
@@ -104,9 +195,9 @@ class NbIoT:
         return status
 
     def ping(self, addr, timeout=30):
-        """Pings specific pair of ip_address and port
+        """Pings specific ip_address
 
-        :param (str, int) addr: address with port to ping
+        :param str addr: ip address to ping
         :param int timeout: timeout for urc
         :return: operation status
         :rtype bool
@@ -114,31 +205,58 @@ class NbIoT:
         self.__log("### PING ###")
         ping_status = False
         self.set_urc(1)
-        self._complex_cmd = NPING.format(addr)
-        status, _ = self.__execute_cmd(NPING)
-        urc = self.read_urc(timeout)
-        self.set_urc(0)
+        # results of earlier pings would be taken for this one
+        self.discard_urc(URC_PING_PREFIXES)
+        status = self.send_ping(addr)
 
-        pattern = re.compile("+NPING:\s\d?(.*),(\d+),(\d+)")
-        for x in urc:
-            search = pattern.findall(x)
+        if status:
+            pattern = re.compile(URC_NPING)
+            error_pattern = re.compile(URC_NPINGERR)
+            urc = self.read_urc(timeout, until=lambda x: pattern.search(x) or error_pattern.search(x))
 
-            if len(search) >= 2:
-                ping_status = True
-                self.__log(search)
+            for x in urc:
+                search = pattern.findall(x)
+
+                if len(search) > 0:
+                    ping_status = True
+                    self.__log(search)
+        self.set_urc(0)
 
         self.__log("##############")
         return ping_status
 
-    def send_to(self, data, addr):
-        """Sends string data to a specific address
+    def send_ping(self, addr):
+        """Starts ping of specific ip_address without waiting for the result
 
-        :param str data: data to send
-        :param (str, int) addr: (ip_address, port)
+        The result arrives later as +NPING (URC_NPING) or +NPINGERR (URC_NPINGERR) urc, see read_urc.
+
+        :param str addr: ip address to ping
         :return: operation status
         :rtype: bool
         """
+        self._complex_cmd = NPING.format(addr)
+        status, _ = self.__execute_cmd(NPING)
+
+        return status
+
+    def send_to(self, data, addr, low_priority=False):
+        """Sends data to a specific address
+
+        :param str|bytes data: data to send, at most SOST_MAX_LEN bytes
+        :param (str, int) addr: (ip_address, port)
+        :param bool low_priority: may be throttled or rejected by the accountant budgets
+        :return: operation status, False also when low priority send is rejected by the accountant
+        :rtype: bool
+        """
         self.__log("### SEND_TO ###")
+        if isinstance(data, str):
+            data = data.encode()
+
+        if self.accountant is not None and not self.accountant.admit(len(data), low_priority):
+            self.__log("--> Rejected, budget exceeded")
+            self.__log("##############")
+            return False
+
         cmd = SOST.format(self.socket)
         msg_len = len(data)
 
@@ -149,25 +267,68 @@ class NbIoT:
             addr[0],
             addr[1],
             msg_len,
-            binascii.hexlify(data.encode()).decode('utf-8')
+            binascii.hexlify(data).decode('utf-8')
         )
 
-        status, _ = self.__execute_cmd(SOST)
+        self._traffic_owner = (self.socket, addr)
+        try:
+            status, _ = self.__execute_cmd(SOST)
+        finally:
+            self._traffic_owner = None
+        if status and self.accountant is not None:
+            self.accountant.on_uplink(self.socket, addr, msg_len)
         self.__log("##############")
 
         return status
 
-    def read_urc(self, timeout):
+    def send_large(self, data, addr, mtu=SOST_MAX_LEN, low_priority=False):
+        """Sends data of any size to a specific address
+
+        Data is split into datagrams of at most mtu bytes, each starting with fragment header
+        (see fragment.py), the receiver puts it back together with Reassembler.
+
+        :param str|bytes data: data to send
+        :param (str, int) addr: (ip_address, port)
+        :param int mtu: maximal size of a single datagram
+        :param bool low_priority: see send_to
+        :return: operation status, False if any of the fragments failed
+        :rtype: bool
+        """
+        if isinstance(data, str):
+            data = data.encode()
+
+        datagrams = split_payload(data, self._msg_ids.next(), min(mtu, SOST_MAX_LEN))
+        self.__log("### SEND_LARGE ({} bytes in {} datagrams) ###".format(len(data), len(datagrams)))
+
+        for datagram in datagrams:
+            if not self.send_to(datagram, addr, low_priority):
+                return False
+
+        return True
+
+    def read_urc(self, timeout, until=None):
         """For a given timeout collects all unsolicited response codes
 
+        Urcs received while waiting for responses of other commands (see URC_PREFIXES) are returned first.
+
         :param int timeout: timeout for urc
+        :param callable until: called with every urc, collecting stops early when it returns True
         :return: all urcs collected during the given time period
         :rtype: list(str)
         """
-        start = timer()
+        start = self.__now()
         urc = []
+        while self._urc:
+            x = self._urc.popleft()
+            urc.append(x)
+
+            if until is not None and until(x):
+                return urc
+
         while True:
             x = self.serial.readline()
+            if self.accountant is not None:
+                self.accountant.on_serial_rx(len(x))
             try:
                 x = x.decode()
             except UnicodeDecodeError as e:
@@ -179,11 +340,29 @@ class NbIoT:
                 urc.append(x)
                 self.__log("<-- %s" % x)
 
-            now = timer()
+                if until is not None and until(x):
+                    return urc
+
+            now = self.__now()
             if (now - start) >= timeout:
                 return urc
 
-            time.sleep(0.1)
+            if len(x) == 0:
+                self.__sleep(0.1)
+
+    def discard_urc(self, prefixes=None):
+        """Drops urcs received while waiting for responses of other commands
+
+        :param tuple(str) prefixes: drop only urcs starting with one of them, None to drop all
+        :return: number of dropped urcs
+        :rtype: int
+        """
+        kept = [x for x in self._urc if prefixes is not None and not x.startswith(prefixes)]
+        dropped = len(self._urc) - len(kept)
+        self._urc.clear()
+        self._urc.extend(kept)
+
+        return dropped
 
     def set_urc(self, n):
         """Enables/Disabled URC mode
@@ -240,6 +419,57 @@ class NbIoT:
 
         return status
 
+    def get_radio_stats(self):
+        """Gets radio statistics (signal power, SNR, ECL, cell...) and sets corresponding class member
+
+        Values are reported the same way as by the modem, power in tenths of dBm and SNR in tenths of dB.
+
+        :return: operation status
+        :rtype: bool
+        """
+        self.__log("### RADIO STATS ###")
+        status, _ = self.__execute_cmd(UESTATS)
+
+        if status:
+            stats = {}
+            for line in self._response:
+                # "Signal power:-745" or "NUESTATS:RADIO,Signal power,-745" depending on firmware
+                if line.startswith("NUESTATS:"):
+                    parts = line[len("NUESTATS:"):].split(',')[1:]
+                else:
+                    parts = line.split(':', 1)
+
+                if len(parts) != 2:
+                    continue
+
+                key = parts[0].strip().lower().replace(' ', '_')
+                value = parts[1].strip().strip('"')
+                try:
+                    value = int(value)
+                except ValueError:
+                    pass
+                stats[key] = value
+
+            self.radio_stats = stats
+        self.__log("##############")
+
+        return status
+
+    def get_signal_quality(self):
+        """Gets received signal strength and bit error rate and sets corresponding class member
+
+        :return: operation status
+        :rtype: bool
+        """
+        self.__log("### SIGNAL QUALITY ###")
+        status, csq = self.__execute_cmd(CSQ)
+
+        if status and csq is not None:
+            self.csq = (int(csq[0]), int(csq[1]))
+        self.__log("##############")
+
+        return status
+
     def get_pdp_context(self):
         """Gets current PDP context definition
 
@@ -293,23 +523,136 @@ class NbIoT:
 
         return status
 
-    @timeout_decorator.timeout(180)
-    def __check_if_attached(self):
-        """Waits up to 3 minutes for modem to get attached to the network
+    def __attach(self, bands, earfcn, pci, timeout, fallback_on_timeout):
+        """Reboots the modem and waits until it gets attached to the network
+
+        :param list(int) bands: LTE bands to search, None to keep the modem configuration
+        :param int earfcn: EARFCN to lock to, None to search all
+        :param int pci: physical cell id to lock to together with earfcn
+        :param int timeout: seconds to wait for attach
+        :param bool fallback_on_timeout: return False when not attached in time, so the caller can try
+            another search, otherwise TimeoutError is raised
+        :return: True if attached, False if not attached in time and fallback_on_timeout is set
+        :rtype: bool
+        :raises timeout_decorator.TimeoutError: when not attached in time and fallback_on_timeout is not set
+        """
+        self.reboot()
+
+        if bands is not None or earfcn is not None:
+            # band and EARFCN can be changed only with radio off
+            self.__radio_off()
+            if bands is not None:
+                self.set_bands(bands)
+            if earfcn is not None:
+                self.lock_earfcn(earfcn, pci)
+
+        self.__radio_on()
+        self.__set_apn()
+        self.__select_operator()
+
+        if not fallback_on_timeout:
+            self.__check_if_attached(timeout)
+            return True
+
+        try:
+            self.__check_if_attached(timeout)
+        except timeout_decorator.TimeoutError:
+            self.__log("--> Not attached in {}s".format(timeout))
+            return False
+
+        return True
+
+    def get_bands(self):
+        """Gets LTE bands the modem searches and sets corresponding class member
+
+        :return: operation status
+        :rtype: bool
+        """
+        self.__log("### GET BANDS ###")
+        status, bands = self.__execute_cmd(NBANDR)
+
+        if status and bands is not None:
+            self.modem_bands = [int(band) for band in bands.split(',') if band]
+        self.__log("##############")
+
+        return status
+
+    def set_bands(self, bands):
+        """Limits cell search to the given LTE bands
+
+        :param list(int) bands: e.g. [8, 20]
+        :return: operation status
+        :rtype: bool
+        """
+        self.__log("### SET BANDS ###")
+        self._complex_cmd = NBAND.format(",".join(str(band) for band in bands))
+        status, _ = self.__execute_cmd(NBAND)
+        self.__log("##############")
+
+        return status
+
+    def lock_earfcn(self, earfcn, pci=None):
+        """Locks cell search to the given EARFCN and optionally to the given cell
+
+        :param int earfcn: downlink EARFCN
+        :param int pci: physical cell id
+        :return: operation status
+        :rtype: bool
+        """
+        self.__log("### LOCK EARFCN ###")
+        params = str(earfcn)
+        if pci is not None:
+            params += ",\"{:x}\"".format(pci)
+        self._complex_cmd = NEARFCN.format(params)
+        status, _ = self.__execute_cmd(NEARFCN)
+        self.__log("##############")
+
+        return status
+
+    def __learn_profile(self):
+        """Saves serving cell of the current attach to the profiles
+        """
+        if self.profiles is None or not self.get_radio_stats():
+            return
+
+        earfcn = self.radio_stats.get('earfcn')
+        if not isinstance(earfcn, int):
+            return
+
+        pci = self.radio_stats.get('pci')
+        self.profiles.save(
+            self.site,
+            earfcn,
+            pci=pci if isinstance(pci, int) else None,
+            cell_id=self.radio_stats.get('cell_id'),
+            attach_time=self.attach_time,
+            modem_bands=self.modem_bands
+        )
+        self.__log("--> Learned EARFCN {} (band {})".format(earfcn, band_from_earfcn(earfcn)))
+
+    def __check_if_attached(self, timeout=180):
+        """Waits up to timeout seconds (3 minutes by default) for modem to get attached to the network
+
+        :param int timeout: seconds to wait
+        :raises timeout_decorator.TimeoutError: when not attached in time
 
         .. seealso:: SARA-N2_ATCommands manual, point 9.3 "Response time up to 3 min"
         """
-        self.__log("### CHECK IF ATTACHED (up to 180s) ###")
+        timeout_decorator.timeout(timeout)(self.__wait_attached)(timeout)
+
+    def __wait_attached(self, timeout):
+        """Polls attach status until modem is attached
+
+        :param int timeout: only logged, enforced by __check_if_attached
+        """
+        self.__log("### CHECK IF ATTACHED (up to {}s) ###".format(timeout))
         online = False
 
         while not online:
-            status, cgatt = self.__execute_cmd(GPRS)
-
-            if status:
-                online = bool(int(cgatt))
+            online = self.is_attached()
 
             if not online:
-                time.sleep(5)
+                self.__sleep(5)
 
         self.__log("##############")
 
@@ -348,12 +691,39 @@ class NbIoT:
 
         return status
 
-    # def receive_from(self):
-    #     self.__log("### RECEIVE ###")
-    #     self._complex_cmd = SORF.format(self.socket, 200)
-    #
-    #     status, _ = self.__execute_cmd(SORF)
-    #     self.__log("##############")
+    def receive_from(self, max_len=SOST_MAX_LEN):
+        """Reads single datagram received on the socket
+
+        :param int max_len: maximal number of bytes to read
+        :return: operation status, received data and (ip_address, port) of the sender, data and address
+            are None when nothing was received
+        :rtype: (bool, bytes, (str, int))
+        """
+        self.__log("### RECEIVE ###")
+        self._complex_cmd = SORF.format(self.socket, max_len)
+        self._traffic_owner = (self.socket, None)
+        try:
+            status, received = self.__execute_cmd(SORF)
+        finally:
+            self._traffic_owner = None
+        self.__log("##############")
+
+        if not status or received is None:
+            return status, None, None
+
+        # <socket>,<ip_address>,<port>,<length>,<data>,<remaining_length>
+        ip, port, _, data, _ = received
+        return status, binascii.unhexlify(data), (ip, int(port))
+
+    def is_attached(self):
+        """Checks once if modem is attached to the network
+
+        :return: attach status
+        :rtype: bool
+        """
+        status, cgatt = self.__execute_cmd(GPRS)
+
+        return status and cgatt is not None and bool(int(cgatt))
 
     def __set_apn(self):
         """Sets APN
@@ -547,7 +917,11 @@ class NbIoT:
             self._complex_cmd = None
 
         self.__log("---> %s" % full_cmd)
-        self.serial.write(full_cmd.encode())
+        full_cmd = full_cmd.encode()
+        if self.accountant is not None:
+            socket, addr = self._traffic_owner or (None, None)
+            self.accountant.on_command(self._cmd, len(full_cmd), socket, addr)
+        self.serial.write(full_cmd)
 
     def __read_response(self):
         """Reads serial response from the modem
@@ -564,8 +938,12 @@ class NbIoT:
         if expected_pattern is not None:
             pattern = re.compile(expected_pattern)
 
+        self._response = []
         while not last_line_found:
             x = self.serial.readline()
+            if self.accountant is not None:
+                socket, addr = self._traffic_owner or (None, None)
+                self.accountant.on_serial_rx(len(x), socket, addr)
 
             try:
                 x = x.decode()
@@ -575,11 +953,17 @@ class NbIoT:
             x = x.replace('\r', '').replace('\n', '')
 
             if len(x) == 0:
-                time.sleep(0.1)
+                self.__sleep(0.1)
                 continue
 
             self.__log("<-- %s" % x)
 
+            if x.startswith(URC_PREFIXES):
+                self._urc.append(x)
+                continue
+
+            self._response.append(x)
+
             if x == R_OK:
                 status = True
 
@@ -0,0 +1,126 @@
+# Copyright (C) 2018  Distributed Arctic Observatory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Learned network profiles used to shorten cell search
+"""
+
+import json
+import os
+import time
+
+# (band, first downlink EARFCN, last downlink EARFCN), see 3GPP TS 36.101 table 5.7.3-1
+EARFCN_BANDS = [
+    (1, 0, 599),
+    (2, 600, 1199),
+    (3, 1200, 1949),
+    (4, 1950, 2399),
+    (5, 2400, 2649),
+    (8, 3450, 3799),
+    (12, 5010, 5179),
+    (13, 5180, 5279),
+    (17, 5730, 5849),
+    (18, 5850, 5999),
+    (19, 6000, 6149),
+    (20, 6150, 6449),
+    (25, 8040, 8689),
+    (26, 8690, 9039),
+    (28, 9210, 9659),
+    (66, 66436, 67335),
+    (71, 68586, 68935),
+    (85, 70366, 70545)
+]
+
+
+def band_from_earfcn(earfcn):
+    """Finds LTE band of the downlink EARFCN
+
+    :param int earfcn:
+    :return: band number or None if not known
+    :rtype: int
+    """
+    for band, first, last in EARFCN_BANDS:
+        if first <= earfcn <= last:
+            return band
+
+    return None
+
+
+class NetworkProfileStore:
+    """Keeps band/EARFCN/cell of the last successful attach for every site in a JSON file
+
+    Stored profile is a dict with keys band, earfcn, pci, cell_id, attach_time (seconds), modem_bands (band
+    list configured in the modem before it was narrowed to the profile band) and updated (unix time).
+
+    :ivar str path: JSON file
+    :ivar dict profiles: site -> profile
+    """
+
+    def __init__(self, path):
+        """
+        :param str path: JSON file, created on the first save
+        """
+        self.path = path
+        self.profiles = {}
+
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.profiles = json.load(f)
+
+    def get(self, site):
+        """Returns profile of the site
+
+        :param str site:
+        :return: profile or None if the site is not known
+        :rtype: dict
+        """
+        return self.profiles.get(str(site))
+
+    def save(self, site, earfcn, pci=None, cell_id=None, attach_time=None, modem_bands=None):
+        """Stores profile of the site
+
+        :param str site:
+        :param int earfcn: downlink EARFCN of the serving cell
+        :param int pci: physical cell id of the serving cell
+        :param object cell_id: cell id as reported by the modem
+        :param float attach_time: seconds it took to attach
+        :param list(int) modem_bands: bands configured in the modem before connect
+        """
+        self.profiles[str(site)] = {
+            'band': band_from_earfcn(earfcn),
+            'earfcn': earfcn,
+            'pci': pci,
+            'cell_id': cell_id,
+            'attach_time': attach_time,
+            'modem_bands': modem_bands,
+            'updated': time.time()
+        }
+        self.__write()
+
+    def forget(self, site):
+        """Removes profile of the site
+
+        :param str site:
+        """
+        if self.profiles.pop(str(site), None) is not None:
+            self.__write()
+
+    def __write(self):
+        """Writes all profiles to the file, replacing it atomically
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.profiles, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,177 @@
+# Copyright (C) 2018  Distributed Arctic Observatory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Round trip time measurement towards many targets with NPING
+"""
+
+import re
+import time
+from collections import deque
+from timeit import default_timer as timer
+from .atcommands import URC_NPING, URC_NPINGERR, URC_PING_PREFIXES
+
+
+class PingStats:
+    """Rolling window of ping results for a single target
+
+    :ivar deque results: (rtt in ms, ttl) of the latest pings, None for lost ones
+    :ivar int sent: number of pings sent since creation
+    :ivar int received: number of replies received since creation
+    """
+
+    def __init__(self, window=100):
+        """
+        :param int window: number of latest pings kept
+        """
+        self.results = deque(maxlen=window)
+        self.sent = 0
+        self.received = 0
+
+    def add(self, rtt=None, ttl=None):
+        """Records result of a single ping
+
+        :param int rtt: round trip time in ms, None if ping was lost
+        :param int ttl: time to live of the reply
+        """
+        self.sent += 1
+        if rtt is None:
+            self.results.append(None)
+            return
+
+        self.received += 1
+        self.results.append((rtt, ttl))
+
+    def summary(self):
+        """Computes statistics over the window
+
+        :return: dict with min, avg, p95 and last rtt (ms), last ttl and loss ratio, rtt values are None
+            if no reply is in the window
+        :rtype: dict
+        """
+        replies = [r for r in self.results if r is not None]
+        rtts = sorted(r[0] for r in replies)
+        summary = {
+            'count': len(self.results),
+            'loss': (1.0 - len(replies) / float(len(self.results))) if self.results else None,
+            'min': None,
+            'avg': None,
+            'p95': None,
+            'last': None,
+            'ttl': None
+        }
+
+        if rtts:
+            # nearest rank percentile
+            rank = (95 * len(rtts) + 99) // 100 - 1
+            summary['min'] = rtts[0]
+            summary['avg'] = sum(rtts) / float(len(rtts))
+            summary['p95'] = rtts[rank]
+            summary['last'] = replies[-1][0]
+            summary['ttl'] = replies[-1][1]
+
+        return summary
+
+
+class PingEngine:
+    """Pings many targets at once and keeps per target statistics
+
+    All pings of a round are issued back to back, then +NPING and +NPINGERR urcs are matched as they
+    arrive: replies by ip address, errors (which carry no address) with the oldest outstanding ping.
+    The round ends as soon as every ping is resolved, pings without an answer after timeout are lost.
+    Urcs read before all pings of the round were sent are dropped, they may be late answers of the
+    previous round and would be matched with the wrong ping.
+
+    :ivar NbIoT nb: connected modem
+    :ivar list(str) targets: ip addresses to ping
+    :ivar float timeout: seconds to wait for answers in a single round
+    :ivar dict stats: ip address -> PingStats
+    """
+
+    def __init__(self, nb, targets, window=100, timeout=30):
+        """
+        :param NbIoT nb:
+        :param list(str) targets:
+        :param int window: number of latest pings kept for every target
+        :param float timeout:
+        """
+        self.nb = nb
+        self.targets = list(targets)
+        self.timeout = timeout
+        self.stats = dict((target, PingStats(window)) for target in self.targets)
+
+        self._reply = re.compile(URC_NPING)
+        self._error = re.compile(URC_NPINGERR)
+
+    def run_round(self):
+        """Pings every target once
+
+        :return: ip address -> rtt in ms (None if lost) for this round
+        :rtype: dict
+        """
+        outstanding = []
+        self.nb.discard_urc(URC_PING_PREFIXES)
+        for target in self.targets:
+            if self.nb.send_ping(target):
+                outstanding.append(target)
+            else:
+                self.stats[target].add()
+        self.nb.discard_urc(URC_PING_PREFIXES)
+
+        results = dict((target, None) for target in self.targets)
+
+        def resolve(x):
+            reply = self._reply.search(x)
+            if reply is not None:
+                ip, ttl, rtt = reply.groups()
+                if ip in outstanding:
+                    outstanding.remove(ip)
+                    results[ip] = int(rtt)
+                    self.stats[ip].add(int(rtt), int(ttl))
+            elif self._error.search(x) is not None and outstanding:
+                self.stats[outstanding.pop(0)].add()
+
+            return not outstanding
+
+        if outstanding:
+            self.nb.read_urc(self.timeout, until=resolve)
+
+        for target in outstanding:
+            self.stats[target].add()
+
+        return results
+
+    def run(self, rounds=None, interval=60.0):
+        """Runs rounds spaced by interval seconds
+
+        :param int rounds: number of rounds, None to run forever
+        :param float interval: seconds between starts of consecutive rounds
+        """
+        done = 0
+        while rounds is None or done < rounds:
+            start = timer()
+            self.run_round()
+            done += 1
+
+            if rounds is None or done < rounds:
+                time.sleep(max(0.0, interval - (timer() - start)))
+
+    def summary(self):
+        """Returns statistics of all targets
+
+        :return: ip address -> PingStats.summary()
+        :rtype: dict
+        """
+        return dict((target, stats.summary()) for target, stats in self.stats.items())
@@ -0,0 +1,404 @@
+# Copyright (C) 2018  Distributed Arctic Observatory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Uplink scheduler with traffic classes
+
+Urgent messages always go first, the remaining classes share the modem with deficit round robin
+weighted by bytes. Every class can be shaped with a token bucket. Transfers are scheduled one datagram
+at a time, so a long bulk transfer is preempted at the next chunk boundary when an urgent message arrives.
+"""
+
+import threading
+import time
+from collections import deque
+from timeit import default_timer as timer
+from .atcommands import SOST_MAX_LEN
+
+URGENT = 'urgent'
+TELEMETRY = 'telemetry'
+BULK = 'bulk'
+
+
+class TokenBucket:
+    """Token bucket shaper
+
+    :ivar float rate: tokens (bytes) added per second
+    :ivar float burst: maximal number of tokens
+    :ivar float tokens: currently available tokens
+    """
+
+    def __init__(self, rate, burst):
+        """
+        :param float rate:
+        :param float burst:
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self._last = timer()
+
+    def delay(self, n):
+        """Returns seconds until n tokens are available
+
+        Requests bigger than burst wait for a full bucket.
+
+        :param int n:
+        :rtype: float
+        """
+        self.__refill()
+        needed = min(n, self.burst)
+        if self.tokens >= needed:
+            return 0.0
+
+        return (needed - self.tokens) / self.rate
+
+    def consume(self, n):
+        """Takes n tokens, the bucket may go below zero for requests bigger than burst
+
+        :param int n:
+        """
+        self.__refill()
+        self.tokens -= n
+
+    def __refill(self):
+        """Adds tokens for the time elapsed since the last call
+        """
+        now = timer()
+        self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+
+class TrafficClass:
+    """Scheduling parameters of a single traffic class
+
+    :ivar str name: class name, e.g. URGENT
+    :ivar int weight: share of the modem relative to other weighted classes, None for strict priority
+    :ivar TokenBucket bucket: shaper, None for no shaping
+    :ivar bool low_priority: passed to NbIoT.send_to, see Accountant
+    :ivar int quantum: bytes added to the deficit in every round
+    :ivar int deficit: bytes the class may still send in the current round
+    """
+
+    def __init__(self, name, weight=None, rate=None, burst=None, low_priority=False):
+        """
+        :param str name:
+        :param int weight:
+        :param float rate: bytes per second, None for no shaping
+        :param float burst: bytes, defaults to one second of traffic but at least one datagram
+        :param bool low_priority:
+        """
+        self.name = name
+        self.weight = weight
+        self.bucket = None
+        if rate is not None:
+            self.bucket = TokenBucket(rate, burst if burst is not None else max(rate, SOST_MAX_LEN))
+        self.low_priority = low_priority
+        self.quantum = (weight or 1) * SOST_MAX_LEN
+        self.deficit = 0
+
+
+class Transfer:
+    """Message or chunked bulk transfer waiting in the scheduler
+
+    :ivar (str, int) addr: (ip_address, port)
+    :ivar TrafficClass traffic_class:
+    :ivar int sent: number of datagrams sent so far
+    :ivar bool status: None while in progress, True when all datagrams were sent, False on error
+    """
+
+    def __init__(self, chunks, addr, traffic_class):
+        """
+        :param iterable chunks: datagrams (str or bytes), consumed lazily
+        :param (str, int) addr:
+        :param TrafficClass traffic_class:
+        """
+        self.addr = addr
+        self.traffic_class = traffic_class
+        self.sent = 0
+        self.status = None
+
+        self._chunks = iter(chunks)
+        self._head = None
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        """Waits until the transfer is finished
+
+        :param float timeout: seconds, None to wait forever
+        :return: transfer status, None if still in progress
+        :rtype: bool
+        """
+        self._done.wait(timeout)
+
+        return self.status
+
+    def peek(self):
+        """Returns the next datagram without removing it
+
+        :return: the next datagram or None when the transfer has no more data
+        :rtype: bytes
+        """
+        if self._head is None:
+            chunk = next(self._chunks, None)
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            self._head = chunk
+
+        return self._head
+
+    def pop(self):
+        """Removes the next datagram
+
+        :rtype: bytes
+        """
+        chunk = self.peek()
+        self._head = None
+
+        return chunk
+
+    def finish(self, status):
+        """Marks the transfer as finished
+
+        :param bool status:
+        """
+        self.status = status
+        self._done.set()
+
+
+class UplinkScheduler:
+    """Schedules uplinks of many traffic classes through a single modem
+
+    Can be driven from the caller thread with step()/run_until_idle() or from a background thread with
+    start(), submit methods are thread safe.
+
+    :ivar NbIoT nb: connected modem
+    :ivar dict classes: class name -> TrafficClass
+    :ivar dict queues: class name -> deque of Transfer
+    """
+
+    def __init__(self, nb, classes=None):
+        """
+        :param NbIoT nb:
+        :param list(TrafficClass) classes: defaults to URGENT (strict), TELEMETRY (weight 4) and BULK (weight 1)
+        """
+        if classes is None:
+            classes = [
+                TrafficClass(URGENT),
+                TrafficClass(TELEMETRY, weight=4),
+                TrafficClass(BULK, weight=1, low_priority=True)
+            ]
+
+        self.nb = nb
+        self.classes = dict((c.name, c) for c in classes)
+        self.queues = dict((c.name, deque()) for c in classes)
+
+        self._strict = [c for c in classes if c.weight is None]
+        self._weighted = [c for c in classes if c.weight is not None]
+        self._rr = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    def submit(self, data, addr, traffic_class=TELEMETRY):
+        """Queues single datagram
+
+        :param str|bytes data: at most SOST_MAX_LEN bytes, bigger transfer fails
+        :param (str, int) addr: (ip_address, port)
+        :param str traffic_class: class name
+        :rtype: Transfer
+        """
+        return self.submit_chunks([data], addr, traffic_class)
+
+    def submit_chunks(self, chunks, addr, traffic_class=BULK):
+        """Queues transfer made of many datagrams, e.g. file parts
+
+        :param iterable chunks: datagrams of at most SOST_MAX_LEN bytes, consumed lazily so it can be a
+            generator, the transfer fails at the first bigger one
+        :param (str, int) addr: (ip_address, port)
+        :param str traffic_class: class name
+        :rtype: Transfer
+        """
+        transfer = Transfer(chunks, addr, self.classes[traffic_class])
+        with self._cond:
+            self.queues[traffic_class].append(transfer)
+            self._cond.notify()
+
+        return transfer
+
+    def pending(self):
+        """Returns number of queued transfers per class
+
+        :rtype: dict
+        """
+        with self._cond:
+            return dict((name, len(queue)) for name, queue in self.queues.items())
+
+    def step(self):
+        """Sends at most one datagram
+
+        :return: seconds until the next datagram can be sent, 0 if sent one now, None if all queues are empty
+        :rtype: float
+        """
+        with self._cond:
+            transfer, chunk, wait = self.__pick()
+
+        if transfer is None:
+            return wait
+
+        self.__send(transfer, chunk)
+        return 0.0
+
+    def run_until_idle(self):
+        """Sends everything queued so far, blocking the caller
+        """
+        while True:
+            wait = self.step()
+            if wait is None:
+                return
+
+            if wait > 0:
+                time.sleep(wait)
+
+    def start(self):
+        """Starts background thread sending queued transfers
+        """
+        self._running = True
+        self._thread = threading.Thread(target=self.__loop, name='nbiotpy-scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops background thread after the datagram being sent
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __loop(self):
+        """Background thread body
+        """
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+
+                transfer, chunk, wait = self.__pick()
+                if transfer is None:
+                    self._cond.wait(wait)
+                    continue
+
+            self.__send(transfer, chunk)
+
+    def __send(self, transfer, chunk):
+        """Sends datagram and finishes the transfer when needed
+
+        :param Transfer transfer:
+        :param bytes chunk:
+        """
+        traffic_class = transfer.traffic_class
+        status = self.nb.send_to(chunk, transfer.addr, low_priority=traffic_class.low_priority)
+
+        with self._cond:
+            queue = self.queues[traffic_class.name]
+            if status:
+                transfer.sent += 1
+                if traffic_class.bucket is not None:
+                    traffic_class.bucket.consume(len(chunk))
+
+            if not status or transfer.peek() is None:
+                if queue and queue[0] is transfer:
+                    queue.popleft()
+                transfer.finish(status)
+
+    def __pick(self):
+        """Selects the next datagram, must be called with the lock held
+
+        :return: transfer, its next datagram and, when nothing can be sent, seconds to wait
+            (None if all queues are empty)
+        :rtype: (Transfer, bytes, float)
+        """
+        wait = None
+
+        for traffic_class in self._strict:
+            transfer, chunk, delay = self.__head(traffic_class)
+            if chunk is not None and delay == 0:
+                return transfer, transfer.pop(), None
+            wait = self.__min(wait, delay)
+
+        count = len(self._weighted)
+        for _ in range(2 * count):
+            traffic_class = self._weighted[self._rr]
+            transfer, chunk, delay = self.__head(traffic_class)
+
+            if chunk is None or delay > 0:
+                if chunk is None:
+                    traffic_class.deficit = 0
+                wait = self.__min(wait, delay)
+                self._rr = (self._rr + 1) % count
+                continue
+
+            if len(chunk) <= traffic_class.deficit:
+                traffic_class.deficit -= len(chunk)
+                return transfer, transfer.pop(), None
+
+            traffic_class.deficit += traffic_class.quantum
+            # the chunk fits in a later round, never report queues with data as empty
+            wait = self.__min(wait, 0.0)
+            self._rr = (self._rr + 1) % count
+
+        return None, None, wait
+
+    def __head(self, traffic_class):
+        """Returns the first datagram of the class
+
+        Transfers without data left are finished on the way, transfers with a datagram bigger than
+        SOST_MAX_LEN are finished as failed.
+
+        :param TrafficClass traffic_class:
+        :return: transfer, datagram (None if the queue is empty) and seconds the shaper delays it
+        :rtype: (Transfer, bytes, float)
+        """
+        queue = self.queues[traffic_class.name]
+        while queue:
+            transfer = queue[0]
+            chunk = transfer.peek()
+            if chunk is None or len(chunk) > SOST_MAX_LEN:
+                queue.popleft()
+                transfer.finish(chunk is None)
+                continue
+
+            delay = 0.0
+            if traffic_class.bucket is not None:
+                delay = traffic_class.bucket.delay(len(chunk))
+
+            return transfer, chunk, delay
+
+        return None, None, None
+
+    @staticmethod
+    def __min(a, b):
+        """Minimum ignoring None values
+        """
+        if a is None:
+            return b
+        if b is None:
+            return a
+
+        return min(a, b)
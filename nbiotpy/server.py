@@ -0,0 +1,622 @@
+# Copyright (C) 2018  Distributed Arctic Observatory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Asyncio UDP server receiving uploads from many devices
+
+Two uplink protocols are understood:
+
+* file transfer used by examples/send_file.py, start message ``0#<name>#<parts>#<sha256>`` followed by
+  parts ``<n>#<hex data>`` numbered from 1
+* fragmented payloads sent with NbIoT.send_large, see fragment.py
+
+Devices are identified by (ip_address, port). File parts are hashed and written in order as they come,
+parts arriving ahead of order are buffered up to a limit, so memory does not depend on file size.
+"""
+
+import argparse
+import asyncio
+import binascii
+import hashlib
+import os
+import socket
+from collections import OrderedDict
+from timeit import default_timer as timer
+from .fragment import FRAG_MAGIC, Reassembler
+
+START_MSG = "0#{}#{}#{}"
+PART_MSG = "{}#{}"
+
+
+def encode_file(name, data, part_size):
+    """Builds messages of the file transfer protocol, the same way as examples/send_file.py
+
+    :param str name: file name
+    :param bytes data: file content
+    :param int part_size: raw bytes per part
+    :return: start message followed by parts
+    :rtype: list(str)
+    """
+    parts = [data[i:i + part_size] for i in range(0, len(data), part_size)]
+    messages = [START_MSG.format(name, len(parts), hashlib.sha256(data).hexdigest())]
+    for counter, part in enumerate(parts, 1):
+        messages.append(PART_MSG.format(counter, binascii.hexlify(part).decode()))
+
+    return messages
+
+
+class DeviceStats:
+    """Traffic statistics of a single device
+
+    :ivar int datagrams: datagrams received
+    :ivar int bytes: bytes received
+    :ivar int parts: file parts and fragments accepted
+    :ivar int duplicates: parts received more than once
+    :ivar int lost: parts never received (counted when upload or fragmented message times out or is replaced)
+    :ivar int completed: files and messages stored with correct checksum
+    :ivar int corrupted: files with wrong checksum
+    :ivar float first_seen: timer value of the first datagram
+    :ivar float last_seen: timer value of the latest datagram
+    """
+
+    def __init__(self):
+        self.datagrams = 0
+        self.bytes = 0
+        self.parts = 0
+        self.duplicates = 0
+        self.lost = 0
+        self.completed = 0
+        self.corrupted = 0
+        self.first_seen = timer()
+        self.last_seen = self.first_seen
+
+    def throughput(self):
+        """Returns average received bytes per second
+
+        :rtype: float
+        """
+        elapsed = self.last_seen - self.first_seen
+        if elapsed <= 0:
+            return 0.0
+
+        return self.bytes / elapsed
+
+    def loss(self):
+        """Returns ratio of lost parts
+
+        :rtype: float
+        """
+        total = self.parts + self.lost
+        if total == 0:
+            return 0.0
+
+        return self.lost / float(total)
+
+
+class Upload:
+    """File being received from a single device
+
+    :ivar str name: file name
+    :ivar int parts: number of parts
+    :ivar str checksum: expected sha256 hex digest
+    :ivar str path: temporary file with data received so far
+    :ivar int next_part: number of the next part to write
+    :ivar dict pending: parts received ahead of order, part number -> data
+    :ivar float last_seen: timer value of the latest part
+    """
+
+    def __init__(self, name, parts, checksum, path):
+        """
+        :param str name:
+        :param int parts:
+        :param str checksum:
+        :param str path:
+        """
+        self.name = name
+        self.parts = parts
+        self.checksum = checksum.lower()
+        self.path = path
+        self.next_part = 1
+        self.pending = {}
+        self.last_seen = timer()
+
+        self._hash = hashlib.sha256()
+        self._buffer = []
+        self._buffered = 0
+
+        # truncate leftovers of a previous upload
+        open(path, 'wb').close()
+
+    def add(self, number, data, flush_size):
+        """Adds part, writing all parts which are now in order
+
+        :param int number: part number
+        :param bytes data: raw part data
+        :param int flush_size: bytes kept in memory before appending them to the file
+        """
+        self.pending[number] = data
+        while self.next_part in self.pending:
+            chunk = self.pending.pop(self.next_part)
+            self._hash.update(chunk)
+            self._buffer.append(chunk)
+            self._buffered += len(chunk)
+            self.next_part += 1
+
+        if self._buffered >= flush_size or self.is_complete():
+            self.flush()
+
+    def has(self, number):
+        """Checks if part was already received
+
+        :param int number:
+        :rtype: bool
+        """
+        return number < self.next_part or number in self.pending
+
+    def is_complete(self):
+        """Checks if all parts were written
+
+        :rtype: bool
+        """
+        return self.next_part > self.parts
+
+    def is_valid(self):
+        """Checks if checksum of written data matches the expected one
+
+        :rtype: bool
+        """
+        return self._hash.hexdigest() == self.checksum
+
+    def received(self):
+        """Returns number of parts received
+
+        :rtype: int
+        """
+        return self.next_part - 1 + len(self.pending)
+
+    def flush(self):
+        """Appends buffered data to the temporary file
+        """
+        if not self._buffer:
+            return
+
+        with open(self.path, 'ab') as f:
+            f.write(b"".join(self._buffer))
+        self._buffer = []
+        self._buffered = 0
+
+
+class IngestionServer(asyncio.DatagramProtocol):
+    """Receives uploads from many devices at once
+
+    :ivar str out_dir: directory where received files are stored, in subdirectory per device
+    :ivar float timeout: seconds after which unfinished upload is dropped
+    :ivar int max_pending: maximal number of out of order parts buffered per upload
+    :ivar int max_uploads: maximal number of uploads in progress
+    :ivar int flush_size: bytes of a single upload kept in memory before writing
+    :ivar dict uploads: device -> Upload
+    :ivar dict orphans: device -> (timer value, {part number: data}) for parts received before start message
+    :ivar OrderedDict finished: (device, name, parts, checksum) -> timer value of uploads finished in the last
+        2 * timeout seconds (at most max_uploads of them), the oldest first, their late datagrams are duplicates
+    :ivar dict stats: device -> DeviceStats
+    :ivar Reassembler reassembler: reassembler of fragmented payloads
+    """
+
+    def __init__(self, out_dir, timeout=300.0, max_pending=256, max_uploads=10000, flush_size=64 * 1024,
+                 receive_buffer=8 * 1024 * 1024):
+        """
+        :param str out_dir:
+        :param float timeout:
+        :param int max_pending:
+        :param int max_uploads:
+        :param int flush_size:
+        :param int receive_buffer: socket receive buffer size, absorbs bursts from many devices
+        """
+        self.out_dir = out_dir
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.max_uploads = max_uploads
+        self.flush_size = flush_size
+        self.receive_buffer = receive_buffer
+        self.uploads = {}
+        self.orphans = {}
+        self.finished = OrderedDict()
+        self.stats = {}
+        self.reassembler = Reassembler(max_messages=max_uploads, timeout=timeout, on_drop=self.__fragments_lost)
+
+        self.transport = None
+        self._messages = 0
+        self._expire_task = None
+
+    async def start(self, host='0.0.0.0', port=9000):
+        """Starts listening
+
+        :param str host:
+        :param int port:
+        """
+        loop = asyncio.get_running_loop()
+        os.makedirs(self.out_dir, exist_ok=True)
+        await loop.create_datagram_endpoint(lambda: self, local_addr=(host, port))
+        self._expire_task = loop.create_task(self.__expire_loop())
+
+    def close(self):
+        """Stops listening
+        """
+        if self._expire_task is not None:
+            self._expire_task.cancel()
+        if self.transport is not None:
+            self.transport.close()
+
+    def connection_made(self, transport):
+        """Called by asyncio when the socket is ready
+
+        :param asyncio.DatagramTransport transport:
+        """
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None and self.receive_buffer:
+            # the system may cap the size (net.core.rmem_max on Linux)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+
+    def datagram_received(self, data, addr):
+        """Called by asyncio for every received datagram
+
+        :param bytes data:
+        :param (str, int) addr: sender address
+        """
+        device = (addr[0], addr[1])
+        stats = self.stats.get(device)
+        if stats is None:
+            stats = self.stats[device] = DeviceStats()
+
+        stats.datagrams += 1
+        stats.bytes += len(data)
+        stats.last_seen = timer()
+
+        if not data:
+            return
+
+        if data[0] == FRAG_MAGIC:
+            self.__fragment_received(device, stats, data)
+        else:
+            self.__message_received(device, stats, data)
+
+    def summary(self):
+        """Returns statistics of all devices
+
+        :return: device -> dict with throughput (bytes/s), loss ratio and counters
+        :rtype: dict
+        """
+        result = {}
+        for device, stats in self.stats.items():
+            summary = dict((k, v) for k, v in stats.__dict__.items() if k not in ('first_seen', 'last_seen'))
+            summary['throughput'] = stats.throughput()
+            summary['loss'] = stats.loss()
+            result["{}:{}".format(*device)] = summary
+
+        return result
+
+    def expire(self):
+        """Drops uploads idle for longer than timeout, counting their missing parts as lost
+
+        :return: number of dropped uploads
+        :rtype: int
+        """
+        now = timer()
+        expired = [d for d, upload in self.uploads.items() if now - upload.last_seen >= self.timeout]
+        for device in expired:
+            self.__drop(device)
+
+        expired_orphans = [d for d, orphans in self.orphans.items() if now - orphans[0] >= self.timeout]
+        if expired_orphans:
+            # parts of a finished upload are late duplicates, not parts of a lost one
+            finished_parts = {}
+            for device, _, parts, _ in self.finished:
+                finished_parts[device] = max(parts, finished_parts.get(device, 0))
+
+            for device in expired_orphans:
+                stats = self.stats[device]
+                for number in self.orphans.pop(device)[1]:
+                    if number <= finished_parts.get(device, 0):
+                        stats.duplicates += 1
+                    else:
+                        stats.lost += 1
+
+        # kept longer than orphans, which may arrive up to timeout after the upload finished
+        while self.finished and now - next(iter(self.finished.values())) >= 2 * self.timeout:
+            self.finished.popitem(last=False)
+        self.reassembler.expire()
+
+        return len(expired)
+
+    async def __expire_loop(self):
+        """Periodically drops idle uploads
+        """
+        while True:
+            await asyncio.sleep(max(1.0, self.timeout / 10.0))
+            self.expire()
+
+    def __message_received(self, device, stats, data):
+        """Handles datagram of the file transfer protocol
+
+        :param (str, int) device:
+        :param DeviceStats stats:
+        :param bytes data:
+        """
+        try:
+            fields = data.decode().split('#')
+            number = int(fields[0])
+        except (UnicodeDecodeError, ValueError):
+            return
+
+        if number == 0:
+            if len(fields) != 4:
+                return
+            self.__start_upload(device, fields[1], fields[2], fields[3])
+            return
+
+        if len(fields) != 2:
+            return
+
+        try:
+            chunk = binascii.unhexlify(fields[1])
+        except (binascii.Error, ValueError):
+            return
+
+        upload = self.uploads.get(device)
+        if upload is None:
+            self.__orphan_received(device, stats, number, chunk)
+            return
+
+        self.__add_part(device, stats, upload, number, chunk)
+
+    def __add_part(self, device, stats, upload, number, chunk):
+        """Adds part to the upload, finishing it when complete
+
+        :param (str, int) device:
+        :param DeviceStats stats:
+        :param Upload upload:
+        :param int number: part number
+        :param bytes chunk: raw part data
+        """
+        if number > upload.parts:
+            return
+
+        if upload.has(number):
+            stats.duplicates += 1
+            return
+
+        if len(upload.pending) >= self.max_pending and number != upload.next_part:
+            # buffer full, the part is lost for this upload
+            stats.lost += 1
+            return
+
+        stats.parts += 1
+        upload.last_seen = stats.last_seen
+        upload.add(number, chunk, self.flush_size)
+
+        if upload.is_complete():
+            del self.uploads[device]
+            self.__finish(device, stats, upload)
+
+    def __orphan_received(self, device, stats, number, chunk):
+        """Keeps part which overtook the start message of its upload
+
+        :param (str, int) device:
+        :param DeviceStats stats:
+        :param int number: part number
+        :param bytes chunk: raw part data
+        """
+        orphans = self.orphans.get(device)
+        if orphans is None:
+            if len(self.orphans) >= self.max_uploads:
+                stats.lost += 1
+                return
+            orphans = self.orphans[device] = (stats.last_seen, {})
+
+        if number in orphans[1]:
+            stats.duplicates += 1
+        elif len(orphans[1]) >= self.max_pending:
+            stats.lost += 1
+        else:
+            orphans[1][number] = chunk
+
+    def __start_upload(self, device, name, parts, checksum):
+        """Starts new upload, replacing unfinished one of the same device
+
+        Repeated start message of the upload in progress or of a recently finished one is only counted as
+        duplicate.
+
+        :param (str, int) device:
+        :param str name:
+        :param str parts:
+        :param str checksum:
+        """
+        try:
+            parts = int(parts)
+        except ValueError:
+            return
+
+        name = os.path.basename(name)
+        if name in ('', '.', '..'):
+            name = 'unnamed'
+        stats = self.stats[device]
+
+        if (device, name, parts, checksum.lower()) in self.finished:
+            stats.duplicates += 1
+            return
+
+        current = self.uploads.get(device)
+        if current is not None:
+            if (current.name, current.parts, current.checksum) == (name, parts, checksum.lower()):
+                stats.duplicates += 1
+                return
+            self.__drop(device)
+
+        if len(self.uploads) >= self.max_uploads:
+            return
+
+        path = os.path.join(self.__device_dir(device), name + '.part')
+        try:
+            upload = Upload(name, parts, checksum, path)
+        except OSError:
+            # e.g. name too long for the file system
+            stats.corrupted += 1
+            return
+
+        if parts == 0:
+            self.__finish(device, stats, upload)
+            return
+
+        self.uploads[device] = upload
+        orphans = self.orphans.pop(device, None)
+        if orphans is not None:
+            for number, chunk in sorted(orphans[1].items()):
+                if device in self.uploads:
+                    self.__add_part(device, stats, upload, number, chunk)
+
+    def __finish(self, device, stats, upload):
+        """Verifies checksum and moves complete file to its final name
+
+        File which cannot be stored is counted as corrupted.
+
+        :param (str, int) device:
+        :param DeviceStats stats:
+        :param Upload upload:
+        """
+        key = (device, upload.name, upload.parts, upload.checksum)
+        self.finished[key] = timer()
+        self.finished.move_to_end(key)
+        while len(self.finished) > self.max_uploads:
+            self.finished.popitem(last=False)
+
+        try:
+            upload.flush()
+            if upload.is_valid():
+                os.replace(upload.path, os.path.join(self.__device_dir(device), upload.name))
+                stats.completed += 1
+                return
+        except OSError:
+            pass
+
+        stats.corrupted += 1
+        try:
+            os.remove(upload.path)
+        except OSError:
+            pass
+
+    def __drop(self, device):
+        """Drops unfinished upload
+
+        :param (str, int) device:
+        """
+        upload = self.uploads.pop(device)
+        self.stats[device].lost += upload.parts - upload.received()
+        if os.path.exists(upload.path):
+            os.remove(upload.path)
+
+    def __fragment_received(self, device, stats, data):
+        """Handles fragment sent with NbIoT.send_large
+
+        :param (str, int) device:
+        :param DeviceStats stats:
+        :param bytes data:
+        """
+        duplicates = self.reassembler.duplicates
+        payload = self.reassembler.feed(data, device)
+
+        if self.reassembler.duplicates > duplicates:
+            stats.duplicates += 1
+            return
+
+        stats.parts += 1
+        if payload is None:
+            return
+
+        self._messages += 1
+        stats.completed += 1
+        path = os.path.join(self.__device_dir(device), "message-{}.bin".format(self._messages))
+        with open(path, 'wb') as f:
+            f.write(payload)
+
+    def __fragments_lost(self, device, msg_id, missing):
+        """Counts fragments of the dropped message as lost, called by the reassembler
+
+        :param (str, int) device:
+        :param int msg_id:
+        :param int missing: number of fragments never received
+        """
+        self.stats[device].lost += missing
+
+    def __device_dir(self, device):
+        """Returns directory of the device, creating it if needed
+
+        :param (str, int) device:
+        :rtype: str
+        """
+        path = os.path.join(self.out_dir, "{}_{}".format(device[0], device[1]))
+        os.makedirs(path, exist_ok=True)
+
+        return path
+
+
+async def serve(out_dir, host, port, report_interval):
+    """Runs the server and prints totals every report_interval seconds
+
+    :param str out_dir:
+    :param str host:
+    :param int port:
+    :param float report_interval:
+    """
+    server = IngestionServer(out_dir)
+    await server.start(host, port)
+    last_bytes = 0
+
+    try:
+        while True:
+            await asyncio.sleep(report_interval)
+            stats = list(server.stats.values())
+            total_bytes = sum(s.bytes for s in stats)
+            print("devices: {} uploads: {} completed: {} corrupted: {} lost parts: {} rate: {:.0f} B/s".format(
+                len(stats),
+                len(server.uploads),
+                sum(s.completed for s in stats),
+                sum(s.corrupted for s in stats),
+                sum(s.lost for s in stats),
+                (total_bytes - last_bytes) / report_interval
+            ))
+            last_bytes = total_bytes
+    finally:
+        server.close()
+
+
+def main():
+    """Entry point of the ingestion server
+    """
+    parser = argparse.ArgumentParser(description='Receives files sent by NB-IoT devices')
+    parser.add_argument('out_dir', help='Directory where received files are stored')
+    parser.add_argument('--host', help='Address to listen on', default='0.0.0.0')
+    parser.add_argument('--port', help='UDP port to listen on', type=int, default=9000)
+    parser.add_argument('--report', help='Seconds between statistics reports', type=float, default=10.0)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.out_dir, args.host, args.port, args.report))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
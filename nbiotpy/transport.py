@@ -0,0 +1,276 @@
+# Copyright (C) 2018  Distributed Arctic Observatory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Serial transports for recording and replaying modem sessions
+
+A transport is any object with ``write(bytes)`` and ``readline()`` methods, like serial.Serial. It may
+also provide ``now()`` and ``sleep(seconds)``, which NbIoT then uses instead of the real clock, so replay
+can skip or scale waiting. Session file starts with ``SESSION_MAGIC`` followed by records::
+
+    +-----------+-----------+--------+------+
+    | time      | direction | length | data |
+    | float64   | uint8     | uint16 |      |
+    +-----------+-----------+--------+------+
+
+Time is counted in seconds from the start of the recording, all fields are little endian. Every
+readline() call is recorded, including empty reads caused by serial timeout.
+"""
+
+import struct
+import time
+from timeit import default_timer as timer
+
+SESSION_MAGIC = b"NBRC\x01"
+SESSION_RECORD = struct.Struct("<dBH")
+
+TX = 0
+RX = 1
+
+
+def read_session(path):
+    """Reads all records from the session file
+
+    :param str path: session file
+    :return: list of (time, direction, data)
+    :rtype: list((float, int, bytes))
+    """
+    records = []
+    with open(path, 'rb') as f:
+        if f.read(len(SESSION_MAGIC)) != SESSION_MAGIC:
+            raise ValueError("Not a session file: {}".format(path))
+
+        while True:
+            header = f.read(SESSION_RECORD.size)
+            if len(header) < SESSION_RECORD.size:
+                break
+
+            t, direction, length = SESSION_RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                break
+
+            records.append((t, direction, data))
+
+    return records
+
+
+class RecordingTransport:
+    """Passes all traffic to the wrapped transport and writes it to the session file
+
+    :ivar object transport: wrapped transport, e.g. serial.Serial
+    :ivar file _file: session file
+    :ivar float _start: timer value at the start of the recording
+    """
+
+    def __init__(self, transport, path):
+        """
+        :param object transport:
+        :param str path: session file, overwritten if exists
+        """
+        self.transport = transport
+        self._file = open(path, 'wb')
+        self._file.write(SESSION_MAGIC)
+        self._start = timer()
+
+    def write(self, data):
+        """Writes data to the wrapped transport
+
+        :param bytes data:
+        :return: value returned by the wrapped transport
+        """
+        self.__record(TX, data)
+        return self.transport.write(data)
+
+    def readline(self):
+        """Reads line from the wrapped transport
+
+        :rtype: bytes
+        """
+        data = self.transport.readline()
+        self.__record(RX, data)
+
+        return data
+
+    def now(self):
+        """Returns current time, the real clock while recording
+
+        :rtype: float
+        """
+        return timer()
+
+    def sleep(self, seconds):
+        """Sleeps in real time while recording
+
+        :param float seconds:
+        """
+        time.sleep(seconds)
+
+    def close(self):
+        """Closes session file and the wrapped transport
+        """
+        self._file.close()
+        if hasattr(self.transport, 'close'):
+            self.transport.close()
+
+    def __record(self, direction, data):
+        """Appends single record to the session file
+
+        :param int direction: TX or RX
+        :param bytes data:
+        """
+        self._file.write(SESSION_RECORD.pack(timer() - self._start, direction, len(data)))
+        self._file.write(data)
+        self._file.flush()
+
+
+class ReplayTransport:
+    """Plays back session file recorded with RecordingTransport
+
+    Lines are returned with the original timing divided by speed, speed None returns them immediately.
+    The transport keeps its own clock in recording time: consuming a record moves it to the record time
+    and sleep() only advances it (never past the next recorded line), so timeouts inside NbIoT expire as
+    in the original session without real waiting.
+
+    readline() never reads past the next recorded write, it returns empty line (like serial timeout)
+    until the library writes again, so replay stays aligned with the commands. After max_overreads such
+    reads in a row the replay has diverged: strict mode raises ValueError, otherwise the recorded write
+    is skipped.
+
+    :ivar list records: (time, direction, data) from the session file
+    :ivar float speed: replay speed, 1.0 is the original speed
+    :ivar bool strict: raise ValueError when written data differs from the recording
+    :ivar int max_overreads: number of reads past the next recorded write tolerated in a row
+    :ivar int position: index of the next record
+    :ivar float _clock: current time in recording time
+    :ivar int _overreads: reads past the next recorded write in a row
+    :ivar float _start: timer value at the start of the replay
+    """
+
+    def __init__(self, path, speed=1.0, strict=False, max_overreads=100):
+        """
+        :param str path: session file
+        :param float speed:
+        :param bool strict:
+        :param int max_overreads:
+        """
+        self.records = read_session(path)
+        self.speed = speed
+        self.strict = strict
+        self.max_overreads = max_overreads
+        self.position = 0
+
+        self._clock = self.records[0][0] if self.records else 0.0
+        self._overreads = 0
+        self._start = None
+
+    def write(self, data):
+        """Consumes the next recorded write
+
+        :param bytes data:
+        :return: number of bytes written
+        :rtype: int
+        """
+        while self.position < len(self.records) and self.records[self.position][1] != TX:
+            self.position += 1
+
+        if self.position >= len(self.records):
+            raise EOFError("Session replay finished")
+
+        t, _, recorded = self.records[self.position]
+        if self.strict and recorded != data:
+            raise ValueError("Replay mismatch at record {}: expected {!r}, got {!r}".format(
+                self.position, recorded, data))
+
+        self.__consume(t)
+        self._overreads = 0
+
+        return len(data)
+
+    def readline(self):
+        """Returns the next recorded line
+
+        :rtype: bytes
+        """
+        if self.position >= len(self.records):
+            raise EOFError("Session replay finished")
+
+        t, direction, data = self.records[self.position]
+        if direction != RX:
+            self._overreads += 1
+            if self._overreads <= self.max_overreads:
+                return b""
+
+            if self.strict:
+                raise ValueError("Replay diverged at record {}: library reads, recording writes {!r}".format(
+                    self.position, data))
+
+            # skip the write the library did not repeat
+            self.position += 1
+            self._overreads = 0
+            return self.readline()
+
+        self.__consume(t)
+
+        return data
+
+    def now(self):
+        """Returns current replay time in recording time
+
+        :rtype: float
+        """
+        return self._clock
+
+    def sleep(self, seconds):
+        """Advances replay clock without waiting, the next record is returned on its own time anyway
+
+        When the library is waiting for the next recorded line, the clock stops at its time, so the wait
+        does not expire earlier than in the original session.
+
+        :param float seconds:
+        """
+        self._clock += seconds
+        if self.position < len(self.records) and self.records[self.position][1] == RX:
+            self._clock = min(self._clock, max(self.records[self.position][0], self._clock - seconds))
+
+    def close(self):
+        """Nothing to release, kept for compatibility with serial.Serial
+        """
+        pass
+
+    def __consume(self, t):
+        """Waits for the record time and moves to the next record
+
+        :param float t: record time relative to the start of the recording
+        """
+        self.__wait(t)
+        self._clock = max(self._clock, t)
+        self.position += 1
+
+    def __wait(self, t):
+        """Sleeps until the record time is reached
+
+        :param float t: record time relative to the start of the recording
+        """
+        if self._start is None:
+            self._start = timer() - t / self.speed if self.speed else timer()
+            return
+
+        if not self.speed:
+            return
+
+        delay = self._start + t / self.speed - timer()
+        if delay > 0:
+            time.sleep(delay)
@@ -12,4 +12,10 @@ setup(name='nbiotpy',
             'pyserial',
             'timeout_decorator'
       ],
+      entry_points={
+            'console_scripts': [
+                  'nbiotpy=nbiotpy.daemon:main',
+                  'nbiotpy-server=nbiotpy.server:main'
+            ]
+      },
       zip_safe=False)